@@ -4,7 +4,6 @@
 import argparse
 import os
 import sys
-import glob
 from subprocess import call
 import shutil
 
@@ -22,6 +21,15 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaAtlasConvergence import CONVERGED_MARKER, displacement_rms, has_converged, log_convergence, relative_change
+from animaCompletionWait import wait_for_flags
+from animaImageAveraging import average_images
+from animaImageResampling import write_identity_transform
+from animaLocalExecutor import run_parallel, split_cores
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -35,14 +43,23 @@ parser.add_argument('-w', '--weights', type=str, default="", help='Weights text
 parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('-j', '--num-workers', type=int, default=0,
+                    help='Number of images warped concurrently, cores being split among them (default: half the number of cores)')
+parser.add_argument('--wait-timeout', type=int, default=0,
+                    help='Maximum time (in seconds) to wait for registrations to be done (default: 0, no timeout)')
+parser.add_argument('--convergence-threshold', type=float, default=0,
+                    help='Relative change of the average below which the atlas is considered converged (default: 0, never)')
+parser.add_argument('--convergence-displacement', type=float, default=0.1,
+                    help='RMS norm (in mm) of the mean transformation below which the atlas is considered converged (default: 0.1)')
+parser.add_argument('--next-ref', type=str, default="",
+                    help='Output of the average resampled on the grid of the next iteration (when its resolution changes)')
+parser.add_argument('--next-ref-geometry', type=str, default="", help='Geometry of the next iteration reference')
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 
 animaCreateImage = os.path.join(animaDir,"animaCreateImage")
-animaAverageImages = os.path.join(animaDir,"animaAverageImages")
 animaImageArithmetic = os.path.join(animaDir,"animaImageArithmetic")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
 
 # test if all images are here
@@ -50,11 +67,11 @@ nimTest = args.num_images
 if args.num_iter == 0:
     nimTest -= 1
 
-numData = len(glob.glob(os.path.join("residualDir",args.prefix + "_*_flag")))
-while numData < nimTest:
-    print("Missing data " + str(numData) + " " + str(nimTest))
-    call(["sleep","600"])
-    numData = len(glob.glob(os.path.join("residualDir", args.prefix + "_*_flag")))
+try:
+    wait_for_flags("residualDir", args.prefix, nimTest, args.wait_timeout)
+except RuntimeError as error:
+    print(error)
+    sys.exit(1)
 
 # if ok proceed
 if args.num_iter == 0:
@@ -77,65 +94,91 @@ for a in range(1,args.num_images + 1):
 
 myfile.close()
 
-command = [animaAverageImages, "-i", "sumNonlinear.txt","-o",os.path.join("residualDir","sumNonlinear_tr.nrrd")]
-if not args.weights == "":
-    command += ["-w",args.weights]
-
-call(command)
+average_images("sumNonlinear.txt", os.path.join("residualDir","sumNonlinear_tr.nrrd"), args.weights)
 
 command = [animaImageArithmetic,"-i",os.path.join("residualDir", "sumNonlinear_tr.nrrd"), "-M", "-1",
            "-o", os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")]
 call(command)
 
-myfileImages = open("refIms.txt","w")
-myfileMasks = open("masksIms.txt","w")
-for a in range(1,args.num_images+1):
+numWorkers, numCoresPerWorker = split_cores(args.num_cores, args.num_images, args.num_workers)
+
+
+def warp_image(a):
     if a == 1 and args.num_iter == 0:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"),
-                   "-o",os.path.join("tempDir", "trsf_" + str(a) + ".xml")]
-        call(command)
+        write_transform_serie_xml([os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")],
+                                  os.path.join("tempDir", "trsf_" + str(a) + ".xml"))
     else:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
-                   "-i", os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd"),
-                   "-i",os.path.join("residualDir","sumNonlinear_inv_tr.nrrd"),
-                   "-o",os.path.join("tempDir","trsf_" + str(a) + ".xml")]
-        call(command)
+        write_transform_serie_xml([os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
+                                   os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd"),
+                                   os.path.join("residualDir","sumNonlinear_inv_tr.nrrd")],
+                                  os.path.join("tempDir","trsf_" + str(a) + ".xml"))
 
     command = [animaApplyTransformSerie, "-i",
                os.path.join(args.prefix_base, args.prefix + "_" + str(a) + args.files_extension),
                "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"), "-g", args.ref_image,
-               "-o",os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(args.num_cores)]
+               "-o",os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(numCoresPerWorker)]
     call(command)
-    myfileImages.write(os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd\n"))
 
     if os.path.exists(os.path.join("Masks", "Mask_" + str(a) + args.files_extension)):
         command = [animaApplyTransformSerie, "-i", os.path.join("Masks", "Mask_" + str(a) + args.files_extension),
                    "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"),
                    "-g", args.ref_image, "-o", os.path.join("tempDir", "Mask_" + str(a) + "_at.nrrd"),
-                   "-n", "nearest", "-p", str(args.num_cores)]
+                   "-n", "nearest", "-p", str(numCoresPerWorker)]
         call(command)
+
+
+run_parallel(warp_image, list(range(1,args.num_images+1)), numWorkers)
+
+# Lists are written once all images are warped to keep them in image order
+myfileImages = open("refIms.txt","w")
+myfileMasks = open("masksIms.txt","w")
+for a in range(1,args.num_images+1):
+    myfileImages.write(os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd\n"))
+
+    if os.path.exists(os.path.join("Masks", "Mask_" + str(a) + args.files_extension)):
         myfileMasks.write(os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd\n"))
 
 myfileImages.close()
 myfileMasks.close()
 
 if args.num_iter == 0:
-    command = [animaAverageImages,"-i","refIms.txt","-o","averageForm1.nrrd"]
+    averageFile = "averageForm1.nrrd"
 else:
-    command = [animaAverageImages,"-i","refIms.txt","-o","averageForm" + str(args.num_iter) + ".nrrd"]
-
-if not args.weights == "":
-    command += ["-w",args.weights]
+    averageFile = "averageForm" + str(args.num_iter) + ".nrrd"
 
 if os.path.exists(os.path.join("Masks","Mask_1" + args.files_extension)):
-    command += ["-m","masksIms.txt"]
+    average_images("refIms.txt", averageFile, args.weights, "masksIms.txt")
+else:
+    average_images("refIms.txt", averageFile, args.weights)
+
+# Convergence measures: mean transformation to the previous average and change of the average itself
+iteration = max(args.num_iter, 1)
+displacement = displacement_rms(os.path.join("residualDir", "sumNonlinear_tr.nrrd"))
+intensityChange = float("nan")
+if os.path.exists("averageForm" + str(iteration - 1) + ".nrrd"):
+    intensityChange = relative_change("averageForm" + str(iteration) + ".nrrd", "averageForm" + str(iteration - 1) + ".nrrd")
+
+log_convergence(iteration, displacement, intensityChange)
+converged = has_converged(displacement, intensityChange, args.convergence_threshold, args.convergence_displacement)
+if converged:
+    # Jobs of the next iterations exit right away, transformations of this last iteration are kept
+    myfile = open(CONVERGED_MARKER, "w")
+    myfile.write(str(iteration) + "\n")
+    myfile.close()
 
-call(command)
+# Next iteration runs at another resolution: the average is resampled on its grid
+if args.next_ref != "" and not converged:
+    write_identity_transform(os.path.join("tempDir", "id_tr.txt"))
+    write_transform_serie_xml([os.path.join("tempDir", "id_tr.txt")], os.path.join("tempDir", "id_tr.xml"))
+
+    command = [animaApplyTransformSerie, "-i", "averageForm" + str(iteration) + ".nrrd", "-t", os.path.join("tempDir", "id_tr.xml"),
+               "-g", args.next_ref_geometry, "-o", args.next_ref, "-p", str(args.num_cores)]
+    call(command)
 
 if args.num_iter == 0:
     if os.path.exists("averageForm1.nrrd"):
         open("it_1_done","w").close()
-        if os.path.exists("iterRun_2"):
+        if os.path.exists("iterRun_2") and not converged:
             shutil.rmtree("residualDir")
             shutil.rmtree("tempDir")
             os.makedirs('tempDir')
@@ -145,7 +188,7 @@ else:
     if os.path.exists("averageForm" + str(args.num_iter) + ".nrrd"):
         open("it_" + str(args.num_iter) + "_done","w").close()
         t = args.num_iter + 1
-        if os.path.exists("iterRun_" + str(t)):
+        if os.path.exists("iterRun_" + str(t)) and not converged:
             shutil.rmtree("residualDir")
             shutil.rmtree("tempDir")
             os.makedirs('tempDir')
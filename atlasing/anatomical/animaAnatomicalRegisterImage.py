@@ -2,10 +2,14 @@
 # Warning: works only on unix-like systems, not windows where "python animaAnatomicalRegisterImage.py ..." has to be run
 
 import argparse
+import atexit
+import glob
 import os
+import socket
 import sys
 from subprocess import call
 import shutil
+import numpy as np
 
 if sys.version_info[0] > 2:
     import configparser as ConfParser
@@ -21,6 +25,13 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaAtlasConvergence import relative_change
+from animaCompletionWait import register_failure_flag, wait_for_flag
+from animaImageIO import read_image, write_image
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,61 +45,187 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-n', '--num-image', type=int, required=True, help='Image number')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Initialize registrations from the transformations of the previous iteration (kept in transformStore)")
+parser.add_argument('--lazy-tolerance', type=float, default=0,
+                    help='Reuse the transformations of the previous iteration when the relative change of the reference within '
+                         'the image support is below this tolerance (default: 0, always register)')
+parser.add_argument('--reuse-dir', type=str, default="",
+                    help='Folder of transformations to reuse instead of registering the image, when it has some for it')
+parser.add_argument('--speculative', action='store_true',
+                    help='Run as one of several concurrent attempts for this image (relaunched straggler): the first attempt '
+                         'to finish commits its transformations, the others exit without output')
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 basePrefBase = os.path.dirname(args.prefix_base)
 
+writeFailureFlag = register_failure_flag(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"))
+
+# Transformations of the previous iteration, kept out of tempDir as it is wiped between iterations. One store per
+# images folder, so that iterations at different resolutions do not share transformations
+storePrefix = os.path.join(basePrefBase,"transformStore",os.path.basename(os.path.normpath(args.prefix_base)),
+                           args.prefix + "_" + str(args.num_image))
+warmStart = args.warm_start is True and os.path.exists(storePrefix + "_aff_tr.txt") and os.path.exists(storePrefix + "_bal_tr.nrrd")
+
+# Concurrent attempts work in their own folder, transformations (and their stored copies) being committed at the end
+workDir = os.path.join(basePrefBase,"tempDir")
+storeOutPrefix = storePrefix
+if args.speculative is True:
+    workDir = os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_attempt_" + socket.gethostname() + "_" + str(os.getpid()))
+    os.makedirs(workDir)
+    storeOutPrefix = os.path.join(workDir,"store")
+
 animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
 animaDenseSVFBMRegistration = os.path.join(animaDir,"animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
+animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
 animaLinearTransformArithmetic = os.path.join(animaDir,"animaLinearTransformArithmetic")
 animaLinearTransformToSVF = os.path.join(animaDir,"animaLinearTransformToSVF")
 animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
 
 filesExtension = args.files_extension
 
-# Rigid / affine registration
-command = [animaPyramidalBMRegistration,"-r",args.ref_image,"-m",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
-           "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
-           "-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-           "--out-rigid",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
-           "--ot","2","-p","3","-l","0","-I","2","-T",str(args.num_cores),"--sym-reg","2"]
-call(command)
-
-# Non-Rigid registration
-
-# For basic atlases
-command = [animaDenseSVFBMRegistration,"-r",args.ref_image,"-m",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
-           "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal.nrrd"),
-           "-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-           "--tub","2","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","1"]
-call(command)
-
-if args.rigid is True:
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
-
-    command = [animaLinearTransformArithmetic,"-i",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
-               "-M","-1","-c",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt")]
-    call(command)
-
-    command = [animaLinearTransformToSVF,"-i",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt"),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
-               "-g",args.ref_image]
+# Transformations already available for this image (e.g. when extending an atlas) are handed to the merge step
+reusePrefix = ""
+if args.reuse_dir != "" and os.path.exists(os.path.join(args.reuse_dir,args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
+    reusePrefix = os.path.join(args.reuse_dir,args.prefix + "_" + str(args.num_image))
+
+# Lazy re-registration: when the reference barely changed (within the support of the registered image) since the
+# image was last registered, the stored transformations are handed to the merge step again
+if reusePrefix == "" and args.lazy_tolerance > 0 and os.path.exists(storePrefix + "_template.txt") and os.path.exists(storePrefix + "_support.nrrd"):
+    previousTemplate = open(storePrefix + "_template.txt").read().strip()
+    if os.path.exists(previousTemplate):
+        templateChange = relative_change(args.ref_image, previousTemplate, storePrefix + "_support.nrrd")
+        print("Reference change within image support: " + str(templateChange))
+        if templateChange < args.lazy_tolerance:
+            reusePrefix = storePrefix
+
+if reusePrefix != "":
+    shutil.copy(reusePrefix + "_linear_tr.txt", os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
+    shutil.copy(reusePrefix + "_nonlinear_tr.nrrd", os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+else:
+    # Rigid / affine registration
+    command = [animaPyramidalBMRegistration,"-r",args.ref_image,"-m",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
+               "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
+               "-O",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
+               "--out-rigid",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
+               "--ot","2","-l","0","-I","2","-T",str(args.num_cores),"--sym-reg","2"]
+    if warmStart:
+        # The previous transformation is close to the solution: coarsest pyramid level is skipped
+        command += ["-i",storePrefix + "_aff_tr.txt","-p","2"]
+    else:
+        command += ["-p","3"]
     call(command)
 
-    command = [animaDenseTransformArithmetic,"-i",os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
-               "-c",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-               "-b",str(args.bch_order),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")]
-    call(command)
-else:
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+    # Non-Rigid registration
+
+    # For basic atlases
+    if warmStart:
+        # Only the residual from the previous non linear transformation is estimated, then composed with it
+        write_transform_serie_xml([os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
+                                   storePrefix + "_bal_tr.nrrd"],
+                                  os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_warm_tr.xml"))
+
+        command = [animaApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
+                   "-t",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_warm_tr.xml"),
+                   "-g",args.ref_image,"-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_warm.nrrd"),
+                   "-p",str(args.num_cores)]
+        call(command)
+
+        command = [animaDenseSVFBMRegistration,"-r",args.ref_image,"-m",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_warm.nrrd"),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal.nrrd"),
+                   "-O",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"),
+                   "--tub","2","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","1","-p","2"]
+        call(command)
+
+        command = [animaDenseTransformArithmetic,"-i",storePrefix + "_bal_tr.nrrd",
+                   "-c",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"),
+                   "-b",str(args.bch_order),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")]
+        call(command)
+
+        os.remove(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_warm.nrrd"))
+        os.remove(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"))
+    else:
+        command = [animaDenseSVFBMRegistration,"-r",args.ref_image,"-m",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal.nrrd"),
+                   "-O",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
+                   "--tub","2","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","1"]
+        call(command)
+
+    if args.warm_start is True:
+        os.makedirs(os.path.dirname(storeOutPrefix), exist_ok=True)
+        shutil.copy(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"), storeOutPrefix + "_aff_tr.txt")
+        shutil.copy(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"), storeOutPrefix + "_bal_tr.nrrd")
+
+    if args.rigid is True:
+        shutil.move(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
+                    os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
+
+        command = [animaLinearTransformArithmetic,"-i",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
+                   "-M","-1","-c",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt")]
+        call(command)
+
+        command = [animaLinearTransformToSVF,"-i",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt"),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
+                   "-g",args.ref_image]
+        call(command)
+
+        command = [animaDenseTransformArithmetic,"-i",os.path.join(workDir, args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
+                   "-c",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
+                   "-b",str(args.bch_order),
+                   "-o",os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")]
+        call(command)
+    else:
+        shutil.move(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
+                    os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
+        shutil.move(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
+                    os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+
+    if args.lazy_tolerance > 0:
+        os.makedirs(os.path.dirname(storeOutPrefix), exist_ok=True)
+
+        supportData, supportHeader = read_image(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal.nrrd"))
+        write_image(storeOutPrefix + "_support.nrrd", (np.asarray(supportData) > 0).astype(np.uint8), supportHeader)
+
+        shutil.copy(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"), storeOutPrefix + "_linear_tr.txt")
+        shutil.copy(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"), storeOutPrefix + "_nonlinear_tr.nrrd")
+
+        myfile = open(storeOutPrefix + "_template.txt","w")
+        myfile.write(os.path.abspath(args.ref_image) + "\n")
+        myfile.close()
+
+if args.speculative is True:
+    # First finisher wins: the commit lock is created exclusively, then outputs are atomically renamed in place
+    outputFiles = [args.prefix + "_" + str(args.num_image) + "_linear_tr.txt", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"]
+    if not all(os.path.exists(os.path.join(workDir,f)) for f in outputFiles):
+        shutil.rmtree(workDir)
+        print("Registration did not produce transformations, nothing to commit")
+        sys.exit(1)
+
+    try:
+        os.close(os.open(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_commit"),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        atexit.unregister(writeFailureFlag)
+        shutil.rmtree(workDir)
+        # Executors stop the other attempt as soon as one succeeds: success is only reported once the attempt holding
+        # the lock has committed its transformations and written the flag
+        print("Transformations being committed by another attempt, waiting for its flag")
+        try:
+            wait_for_flag(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"), timeout=600)
+        except RuntimeError as error:
+            print(error)
+            sys.exit(1)
+        sys.exit(0)
+
+    for f in outputFiles:
+        os.rename(os.path.join(workDir,f), os.path.join(basePrefBase,"tempDir",f))
+
+    for f in glob.glob(storeOutPrefix + "_*"):
+        os.makedirs(os.path.dirname(storePrefix), exist_ok=True)
+        os.replace(f, storePrefix + os.path.basename(f)[len("store"):])
 
 if os.path.exists(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
     os.remove(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
@@ -101,9 +238,15 @@ os.symlink(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_i
 
 if os.path.exists(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
     open(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"), 'a').close()
+    # Marker left by a failed concurrent attempt
+    if os.path.exists(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_failed")):
+        os.remove(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_failed"))
+
+if os.path.exists(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")):
+    os.remove(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"))
 
-if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")):
-    os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"))
+if os.path.exists(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd")):
+    os.remove(os.path.join(workDir,args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"))
 
-if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd")):
-    os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"))
+if args.speculative is True:
+    shutil.rmtree(workDir)
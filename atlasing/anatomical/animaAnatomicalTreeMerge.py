@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaAnatomicalTreeMerge.py ..." has to be run
+
+import argparse
+import math
+import os
+import sys
+from subprocess import call
+import shutil
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+if not os.path.exists(configFilePath):
+    print('Please create a configuration file for Anima python scripts. Refer to the README')
+    quit()
+
+configParser = ConfParser.RawConfigParser()
+configParser.read(configFilePath)
+
+animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaAtlasConvergence import CONVERGED_MARKER, displacement_rms, has_converged, log_convergence, relative_change
+from animaCompletionWait import wait_for_flags
+from animaImageAveraging import accumulate_images, combine_partial_sums, normalize_sum, output_dtype, read_weights, \
+    save_partial_sum
+from animaImageIO import read_image, write_image
+from animaImageResampling import write_identity_transform
+from animaLocalExecutor import run_parallel, split_cores
+from animaTransformSerieXml import write_transform_serie_xml
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Runs one stage of the tree reduction merge of an anatomical atlas iteration: images are split in groups "
+                "whose weighted partial sums (of transformations, then of warped images) are combined by a tree of "
+                "reduction jobs. The last reduction of each tree computes the mean transformation or the new average.")
+parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
+parser.add_argument('-r', '--ref-image', type=str, required=True, help='Reference image')
+parser.add_argument('-e', '--files-extension', type=str, required=True, help='Input files extension')
+parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix base')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
+parser.add_argument('-w', '--weights', type=str, default="", help='Weights text file')
+parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
+parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
+parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('-s', '--stage', type=str, required=True,
+                    choices=["transforms-map", "transforms-reduce", "images-map", "images-reduce"], help='Merge stage')
+parser.add_argument('-l', '--level', type=int, default=0, help='Level of the reduction stage (from 1, maps being level 0)')
+parser.add_argument('-g', '--group', type=int, required=True, help='Group number (from 1, e.g. the OAR array index)')
+parser.add_argument('-G', '--group-size', type=int, default=16, help='Number of images per group of a map stage (default: 16)')
+parser.add_argument('-F', '--fan-in', type=int, default=8, help='Number of partial sums combined by each reduction (default: 8)')
+parser.add_argument('--wait-timeout', type=int, default=0,
+                    help='Maximum time (in seconds) to wait for registrations to be done (default: 0, no timeout)')
+parser.add_argument('--convergence-threshold', type=float, default=0,
+                    help='Relative change of the average below which the atlas is considered converged (default: 0, never)')
+parser.add_argument('--convergence-displacement', type=float, default=0.1,
+                    help='RMS norm (in mm) of the mean transformation below which the atlas is considered converged (default: 0.1)')
+parser.add_argument('--next-ref', type=str, default="",
+                    help='Output of the average resampled on the grid of the next iteration (when its resolution changes)')
+parser.add_argument('--next-ref-geometry', type=str, default="", help='Geometry of the next iteration reference')
+
+args = parser.parse_args()
+os.chdir(args.ref_dir)
+
+animaCreateImage = os.path.join(animaDir,"animaCreateImage")
+animaImageArithmetic = os.path.join(animaDir,"animaImageArithmetic")
+animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
+
+
+def num_groups(level):
+    numGroups = int(math.ceil(args.num_images / args.group_size))
+    for i in range(level):
+        numGroups = int(math.ceil(numGroups / args.fan_in))
+
+    return numGroups
+
+
+def partial_prefix(kind, level, group):
+    return os.path.join("residualDir", "partial_" + kind + "_" + str(level) + "_" + str(group))
+
+
+weights = read_weights(args.weights, args.num_images)
+masksUsed = os.path.exists(os.path.join("Masks", "Mask_1" + args.files_extension))
+
+if args.stage.endswith("map"):
+    groupImages = list(range((args.group - 1) * args.group_size + 1, min(args.group * args.group_size, args.num_images) + 1))
+    groupWeights = [weights[a - 1] for a in groupImages]
+    kind = "tr" if args.stage == "transforms-map" else "im"
+    outputPrefix = partial_prefix(kind, 0, args.group)
+    isLastLevel = num_groups(0) == 1
+else:
+    previousGroups = list(range((args.group - 1) * args.fan_in + 1, min(args.group * args.fan_in, num_groups(args.level - 1)) + 1))
+    kind = "tr" if args.stage == "transforms-reduce" else "im"
+    outputPrefix = partial_prefix(kind, args.level, args.group)
+    isLastLevel = num_groups(args.level) == 1
+
+if args.stage == "transforms-map":
+    # test if all images are here
+    nimTest = args.num_images
+    if args.num_iter == 0:
+        nimTest -= 1
+
+    try:
+        wait_for_flags("residualDir", args.prefix, nimTest, args.wait_timeout)
+    except RuntimeError as error:
+        print(error)
+        sys.exit(1)
+
+    if args.num_iter == 0 and 1 in groupImages:
+        # Write identity transform
+        write_identity_transform(os.path.join("tempDir",args.prefix + "_1_linear_tr.txt"))
+
+        command = [animaCreateImage,"-o",os.path.join("tempDir",args.prefix + "_1_nonlinear_tr.nrrd"),
+                   "-b","0","-g",os.path.join(args.prefix_base,args.prefix + "_1" + args.files_extension),"-v","3"]
+        call(command)
+
+    weightedSum, weightSum, _ = accumulate_images([os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd")
+                                                   for a in groupImages], groupWeights)
+elif args.stage == "images-map":
+    numWorkers, numCoresPerWorker = split_cores(args.num_cores, len(groupImages))
+
+    def warp_image(a):
+        if a == 1 and args.num_iter == 0:
+            write_transform_serie_xml([os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")],
+                                      os.path.join("tempDir", "trsf_" + str(a) + ".xml"))
+        else:
+            write_transform_serie_xml([os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
+                                       os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd"),
+                                       os.path.join("residualDir","sumNonlinear_inv_tr.nrrd")],
+                                      os.path.join("tempDir","trsf_" + str(a) + ".xml"))
+
+        command = [animaApplyTransformSerie, "-i",
+                   os.path.join(args.prefix_base, args.prefix + "_" + str(a) + args.files_extension),
+                   "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"), "-g", args.ref_image,
+                   "-o",os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(numCoresPerWorker)]
+        call(command)
+
+        if masksUsed:
+            command = [animaApplyTransformSerie, "-i", os.path.join("Masks", "Mask_" + str(a) + args.files_extension),
+                       "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"),
+                       "-g", args.ref_image, "-o", os.path.join("tempDir", "Mask_" + str(a) + "_at.nrrd"),
+                       "-n", "nearest", "-p", str(numCoresPerWorker)]
+            call(command)
+
+    run_parallel(warp_image, groupImages, numWorkers)
+
+    maskFiles = None
+    if masksUsed:
+        maskFiles = [os.path.join("tempDir", "Mask_" + str(a) + "_at.nrrd") for a in groupImages]
+
+    weightedSum, weightSum, _ = accumulate_images([os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd")
+                                                   for a in groupImages], groupWeights, maskFiles)
+else:
+    weightedSum, weightSum = combine_partial_sums([partial_prefix(kind, args.level - 1, group) for group in previousGroups])
+
+if not isLastLevel:
+    save_partial_sum(outputPrefix, weightedSum, weightSum)
+    sys.exit(0)
+
+if kind == "tr":
+    # Root of the transformations tree: mean transformation and its inverse, used to warp images
+    _, header = read_image(os.path.join("tempDir",args.prefix + "_1_nonlinear_tr.nrrd"))
+    write_image(os.path.join("residualDir","sumNonlinear_tr.nrrd"),
+                normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+
+    command = [animaImageArithmetic,"-i",os.path.join("residualDir", "sumNonlinear_tr.nrrd"), "-M", "-1",
+               "-o", os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")]
+    call(command)
+    sys.exit(0)
+
+# Root of the images tree: new average, then same end of iteration as animaAnatomicalMergeImages.py
+if args.num_iter == 0:
+    averageFile = "averageForm1.nrrd"
+else:
+    averageFile = "averageForm" + str(args.num_iter) + ".nrrd"
+
+_, header = read_image(os.path.join("tempDir", args.prefix + "_1_at.nrrd"))
+write_image(averageFile, normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+
+# Convergence measures: mean transformation to the previous average and change of the average itself
+iteration = max(args.num_iter, 1)
+displacement = displacement_rms(os.path.join("residualDir", "sumNonlinear_tr.nrrd"))
+intensityChange = float("nan")
+if os.path.exists("averageForm" + str(iteration - 1) + ".nrrd"):
+    intensityChange = relative_change("averageForm" + str(iteration) + ".nrrd", "averageForm" + str(iteration - 1) + ".nrrd")
+
+log_convergence(iteration, displacement, intensityChange)
+converged = has_converged(displacement, intensityChange, args.convergence_threshold, args.convergence_displacement)
+if converged:
+    # Jobs of the next iterations exit right away, transformations of this last iteration are kept
+    myfile = open(CONVERGED_MARKER, "w")
+    myfile.write(str(iteration) + "\n")
+    myfile.close()
+
+# Next iteration runs at another resolution: the average is resampled on its grid
+if args.next_ref != "" and not converged:
+    write_identity_transform(os.path.join("tempDir", "id_tr.txt"))
+    write_transform_serie_xml([os.path.join("tempDir", "id_tr.txt")], os.path.join("tempDir", "id_tr.xml"))
+
+    command = [animaApplyTransformSerie, "-i", averageFile, "-t", os.path.join("tempDir", "id_tr.xml"),
+               "-g", args.next_ref_geometry, "-o", args.next_ref, "-p", str(args.num_cores)]
+    call(command)
+
+if os.path.exists(averageFile):
+    open("it_" + str(iteration) + "_done","w").close()
+    t = iteration + 1
+    if os.path.exists("iterRun_" + str(t)) and not converged:
+        shutil.rmtree("residualDir")
+        shutil.rmtree("tempDir")
+        os.makedirs('tempDir')
+        os.makedirs('residualDir')
+        os.remove("iterRun_" + str(iteration))
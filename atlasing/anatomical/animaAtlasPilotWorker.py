@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaAtlasPilotWorker.py ..." has to be run
+
+import argparse
+import os
+import sys
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+if not os.path.exists(configFilePath):
+    print('Please create a configuration file for Anima python scripts. Refer to the README')
+    quit()
+
+configParser = ConfParser.RawConfigParser()
+configParser.read(configFilePath)
+
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTaskQueue import run_worker
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Pilot worker of atlas construction: pulls registration and merge tasks from a task queue folder and runs "
+                "them one after the other, until the queue is stopped or stays empty for too long.")
+parser.add_argument('-q', '--queue-dir', type=str, required=True, help='Task queue folder')
+parser.add_argument('--heartbeat', type=int, default=30,
+                    help='Interval (in seconds) between heartbeats of the running task (default: 30)')
+parser.add_argument('--idle-timeout', type=int, default=600,
+                    help='Time (in seconds) without any task after which the worker exits (default: 600, 0 for never)')
+
+args = parser.parse_args()
+
+if not os.path.isdir(os.path.join(args.queue_dir, "pending")):
+    print("No task queue in " + args.queue_dir)
+    sys.exit(1)
+
+run_worker(args.queue_dir, args.heartbeat, args.idle_timeout)
@@ -2,12 +2,15 @@
 # Warning: works only on unix-like systems, not windows where "python animaBuildAnatomicalAtlas.py ..." has to be run
 
 import argparse
+import atexit
 import os
 import glob
+import math
 import stat
 import sys
 import subprocess
 import shutil
+import numpy as np
 
 if sys.version_info[0] > 2:
     import configparser as ConfParser
@@ -25,17 +28,76 @@ configParser.read(configFilePath)
 animaDir = configParser.get("anima-scripts", 'anima')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaAtlasConvergence import CONVERGED_MARKER
+from animaImageAveraging import accumulate_images, normalize_sum, output_dtype, read_weights, significant_weights
+from animaImageIO import write_image
+from animaImageResampling import downsample_image
+from animaResolutionSchedule import level_folder, level_reference, next_reference, resolution_factor
+from animaLocalExecutor import get_local_cores, run_jobs, run_speculative_jobs
+from animaTaskQueue import init_queue, run_queued_jobs, stop_workers
+
 # Argument parsing
 parser = argparse.ArgumentParser(
-    description="Builds and runs a series of scripts on an OAR cluster to construct an anatomical atlas (unbiased up to an affine or rigid transform, with different or equal weights).")
+    description="Builds and runs a series of scripts on an OAR cluster (or on the local machine) to construct an anatomical atlas (unbiased up to an affine or rigid transform, with different or equal weights).")
 parser.add_argument('-p', '--data-prefix', type=str, required=True, help='Data prefix (including folder)')
 parser.add_argument('-i', '--num-iterations', type=int, default=8, help='Number of iterations (default: 8)')
 parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images in the atlas')
 parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of cores to run on (default: 8)')
 parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations in rigid unbiased (default: 2)')
 parser.add_argument('-w', '--weights-file', type=str, default="", help='Link to weights file if needed, otherwise using equal weights (default: none)')
+parser.add_argument('--min-weight', type=float, default=0,
+                    help='Leave out of the atlas images whose weight (weights being normalized to sum 1) is below this '
+                         'threshold, remaining weights being renormalized (default: 0, all images)')
+parser.add_argument('--weight-mass', type=float, default=1,
+                    help='Only keep the images of largest weights totalling this fraction of the sum of weights, remaining '
+                         'weights being renormalized (default: 1, all images)')
 parser.add_argument('-r', '--ref-image', type=str, default="", help='Reference image for the first round of registrations')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--select-reference', action='store_true',
+                    help="When no reference image is given, use the medoid of the images instead of the first one, images being compared "
+                         "after aligning their intensity moments (a translation and axis scalings, needs scipy)")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Initialize each registration from the transformations of the same image at the previous iteration")
+parser.add_argument('--lazy-tolerance', type=float, default=0,
+                    help='Keep the previous transformations of an image when the reference changed less than this relative '
+                         'tolerance within its support since it was last registered (default: 0, register all images)')
+parser.add_argument('--resolution-schedule', type=str, default="",
+                    help='Comma separated, non increasing downsampling factors of the iterations, the last one being used for '
+                         'remaining iterations, e.g. 2,2,1 (default: native resolution for all iterations)')
+parser.add_argument('--extend', action='store_true',
+                    help='Extend the atlas of the working folder with new images (numbered after the existing ones, -n '
+                         'being the new total): only new images are registered, then -i refinement iterations are run')
+parser.add_argument('--first-reuse-dir', type=str, default="",
+                    help='Folder of transformations of the images onto the reference image (-r), reused at the first '
+                         'iteration instead of registering the images again (e.g. registrations to a template shared by '
+                         'several atlases)')
+parser.add_argument('--merge-group-size', type=int, default=0,
+                    help='Merge each iteration with a tree reduction over groups of this number of images (default: 0, '
+                         'single merge job)')
+parser.add_argument('--merge-fan-in', type=int, default=8,
+                    help='Number of partial sums combined by each reduction job of the tree merge (default: 8)')
+parser.add_argument('--executor', type=str, default="oar", choices=["oar", "local", "pilot"],
+                    help='Run registrations and merges as OAR jobs, as a local process pool or as tasks of a queue '
+                         'pulled by long-lived pilot workers (default: oar)')
+parser.add_argument('--local-cores', type=int, default=0,
+                    help='Total number of cores used by the local executor (default: all available cores)')
+parser.add_argument('--pilot-workers', type=int, default=4,
+                    help='Number of pilot workers, each running one task at a time on -c cores (default: 4)')
+parser.add_argument('--pilot-launcher', type=str, default="oar", choices=["oar", "local"],
+                    help='Start pilot workers as an OAR job array or as local processes (default: oar)')
+parser.add_argument('--pilot-walltime', type=str, default="23:59:00",
+                    help='Walltime of the OAR pilot workers (default: 23:59:00)')
+parser.add_argument('--pilot-queue', type=str, default="",
+                    help='With the pilot executor, submit tasks to this existing queue, whose workers are started and '
+                         'stopped by the caller (e.g. a queue shared by several atlas builds) instead of starting own workers')
+parser.add_argument('--straggler-factor', type=float, default=0,
+                    help='With the local or pilot executor, relaunch registrations running longer than this factor times '
+                         'the median registration time, once half of them are done (default: 0, no relaunch)')
+parser.add_argument('--convergence-threshold', type=float, default=0,
+                    help='Stop iterating once the relative change of the average falls below this threshold (default: 0, run all iterations)')
+parser.add_argument('--convergence-displacement', type=float, default=0.1,
+                    help='Maximal RMS norm (in mm) of the mean transformation for the atlas to be considered converged (default: 0.1)')
 
 args = parser.parse_args()
 
@@ -73,101 +135,539 @@ if filesExtension == "":
             if filesExtension == '.gz':
                 filesExtension = os.path.splitext(os.path.splitext(f)[0])[1] + filesExtension
 
+# Images of negligible weight are left out: kept images are linked in prunedData with consecutive numbers and their
+# renormalized weights written to prunedWeights.txt, so that next steps only see the kept images
+if args.min_weight > 0 or args.weight_mass < 1:
+    if args.weights_file == "":
+        print("Images can only be left out of an atlas with weights (-w)")
+        sys.exit(1)
+
+    if args.extend is True:
+        print("Images cannot be left out when extending an atlas")
+        sys.exit(1)
+
+    # Merges read masks from the working folder by image number, they cannot be renumbered next to the originals
+    if len(glob.glob(os.path.join("Masks", "Mask_*"))) > 0:
+        print("Images cannot be left out of an atlas with masks (Masks folder)")
+        sys.exit(1)
+
+    weights = read_weights(args.weights_file, args.num_images)
+    keptImages = significant_weights(weights, args.min_weight, args.weight_mass)
+
+    prunedBase = os.path.join(os.getcwd(), "prunedData")
+    if os.path.exists(prunedBase):
+        shutil.rmtree(prunedBase)
+    os.makedirs(prunedBase)
+
+    myfile = open("prunedSubjects.txt", "w")
+    for newIndex, index in enumerate(keptImages, start=1):
+        os.symlink(os.path.abspath(os.path.join(prefixBase, prefix + "_" + str(index + 1) + filesExtension)),
+                   os.path.join(prunedBase, prefix + "_" + str(newIndex) + filesExtension))
+        myfile.write(str(index + 1) + " " + str(weights[index]) + "\n")
+    myfile.close()
+
+    # Transformations reused at the first iteration are numbered as the images
+    if args.first_reuse_dir != "":
+        prunedReuseDir = os.path.join(os.getcwd(), "prunedReuse")
+        if os.path.exists(prunedReuseDir):
+            shutil.rmtree(prunedReuseDir)
+        os.makedirs(prunedReuseDir)
+
+        for newIndex, index in enumerate(keptImages, start=1):
+            for suffix in ["_linear_tr.txt", "_nonlinear_tr.nrrd"]:
+                reuseFile = os.path.join(args.first_reuse_dir, prefix + "_" + str(index + 1) + suffix)
+                if os.path.exists(reuseFile):
+                    os.symlink(os.path.abspath(reuseFile), os.path.join(prunedReuseDir, prefix + "_" + str(newIndex) + suffix))
+
+        args.first_reuse_dir = prunedReuseDir
+
+    np.savetxt("prunedWeights.txt", weights[keptImages] / np.sum(weights[keptImages]))
+
+    print("Keeping " + str(len(keptImages)) + " of " + str(args.num_images) + " images (" +
+          str(round(100 * np.sum(weights[keptImages]) / np.sum(weights), 1)) + "% of the weights)")
+
+    if args.ref_image == "":
+        ref = os.path.join(prunedBase, prefix + "_1")
+    prefixBase = prunedBase
+    args.num_images = len(keptImages)
+    args.weights_file = os.path.join(os.getcwd(), "prunedWeights.txt")
+
+# Reference selection: the selected image is then used as a given reference image. The selection is kept in a file
+# so that a resumed atlas uses the same reference
+if args.ref_image == "" and args.select_reference is True:
+    if os.path.exists("referenceSelection.txt"):
+        selectedImage = int(open("referenceSelection.txt").readline())
+    else:
+        imageFiles = [os.path.join(prefixBase, prefix + "_" + str(index) + filesExtension) for index in range(1, args.num_images + 1)]
+        # Only needed here, as it depends on scipy
+        from animaReferenceSelection import select_medoid
+        selectedIndex, distances = select_medoid(imageFiles)
+        selectedImage = selectedIndex + 1
+
+        myfile = open("referenceSelection.txt", "w")
+        myfile.write(str(selectedImage) + "\n")
+        for index in range(args.num_images):
+            myfile.write(imageFiles[index] + " " + str(distances[index]) + "\n")
+        myfile.close()
+
+    print("Selected reference image: " + str(selectedImage))
+    ref = os.path.join(prefixBase, prefix + "_" + str(selectedImage))
+    args.ref_image = ref + filesExtension
+    firstImage = 1
+
 previousMergeId = 0
 ref = ref + filesExtension
+localCores = get_local_cores(args.local_cores)
 
-for k in range(1,args.num_iterations + 1):
-    if os.path.exists('it_' + str(k) + '_done'):
-        ref = "averageForm" + str(k) + ".nrrd"
-        firstImage = 1
-        continue
+queueDir = os.path.join(os.getcwd(), "taskQueue")
+if args.pilot_queue != "":
+    queueDir = os.path.abspath(args.pilot_queue)
 
-    print("*************Iteration " + str(k) + ", processing reference: " + ref)
+if args.straggler_factor > 0 and args.executor == "oar":
+    print("Straggler relaunch needs the local or pilot executor, OAR jobs being submitted all at once")
+    sys.exit(1)
 
-    for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag'):
-        os.remove(f)
 
-    numJobs = args.num_images - firstImage + 1
-    nCoresPhysical = int(args.num_cores / 2)
+def execute_jobs(commands, log_prefixes, names, straggler_factor=0):
+    # Job array of the local and pilot executors, return codes being given back in the order of the commands.
+    # Runtimes of arrays with straggler relaunch are kept in taskRuntimes.txt
+    statsFile = ""
+    if straggler_factor > 0:
+        statsFile = os.path.join(os.getcwd(), "taskRuntimes.txt")
 
-    fileName = 'iterRun_' + str(k)
-    myfile = open(fileName,"w")
-    myfile.write("#!/bin/bash\n")
-    if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
-    myfile.write("#OAR --array " + str(numJobs) + "\n")
-    myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
-    myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
+    if args.executor == "pilot":
+        if args.pilot_queue != "":
+            # Task names of a shared queue are made unique by the working folder of this atlas
+            names = [os.path.basename(os.getcwd()) + "-" + name for name in names]
 
-    myfile.write("cd " + os.getcwd() + "\n")
+        return run_queued_jobs(queueDir, commands, log_prefixes, names, straggler_factor=straggler_factor,
+                               stats_file=statsFile)
 
-    if k == 1 and args.ref_image == "":
-        numIt=0
-        myfile.write("let index=${OAR_ARRAY_INDEX}+1\n")
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $index -b " + str(args.bch_order) + " -c " + str(args.num_cores))
-    else:
-        numIt=k
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+    if straggler_factor > 0:
+        return run_speculative_jobs(commands, log_prefixes, int(localCores / args.num_cores), straggler_factor,
+                                    stats_file=statsFile)
 
-    if args.rigid is True:
-        myfile.write(" --rigid\n")
-    else:
-        myfile.write("\n")
-
-    myfile.close()
-    os.chmod(fileName, stat.S_IRWXU)
+    return run_jobs(commands, log_prefixes, int(localCores / args.num_cores))
 
-    oarRunCommand = ["oarsub"]
-    if previousMergeId == 0:
-        oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/iterRun_" + str(k)]
-    else:
-        oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/iterRun_" + str(k)]
 
+def submit_oar_job(oar_run_command):
+    # Job ids given by oarsub (one per array index), the atlas cannot go on without them
     jobsIds = []
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+    procStat = subprocess.run(oar_run_command, stdout=subprocess.PIPE)
     statLines = procStat.stdout.decode('utf-8').split('\n')
     for statsLine in statLines:
         if "OAR_JOB_ID" in statsLine:
             jobsIds += [statsLine.split("=")[1]]
 
-    fileName = 'mergeRun_' + str(k)
-    myfile = open(fileName,"w")
-    myfile.write("#!/bin/bash\n")
-    if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
-    myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.output\n")
-    myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.error\n")
+    if len(jobsIds) == 0:
+        print("oarsub gave no OAR_JOB_ID for " + " ".join(oar_run_command) + ", job submission failed")
+        sys.exit(1)
 
-    myfile.write("cd " + os.getcwd() + "\n")
-    myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalMergeImages.py") +
-                 " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(numIt) +
-                 " -n " + str(args.num_images) + " -r " + ref + " -e " + filesExtension + " -c " + str(args.num_cores))
+    return jobsIds
 
-    if not args.weights_file == "":
-        myfile.write(" -w " + args.weights_file + "\n")
+
+if args.first_reuse_dir != "" and args.ref_image == "":
+    print("Transformations of the first iteration can only be reused with a given reference image (-r)")
+    sys.exit(1)
+
+if args.pilot_queue != "" and args.executor != "pilot":
+    print("A pilot queue can only be given with the pilot executor")
+    sys.exit(1)
+
+if args.executor == "pilot" and args.pilot_queue == "":
+    # Workers are started once for all iterations, tasks being packed on them as soon as they are submitted
+    init_queue(queueDir)
+    atexit.register(stop_workers, queueDir)
+
+    # Workers only exit through the stop file: they would otherwise leave while a single merge task runs
+    workerCommand = [os.path.join(animaScriptsDir,"atlasing/anatomical/animaAtlasPilotWorker.py"), "-q", queueDir,
+                     "--idle-timeout", "0"]
+    if args.pilot_launcher == "local":
+        for worker in range(1, args.pilot_workers + 1):
+            with open(os.path.join(os.getcwd(), "pilot." + str(worker) + ".output"), "w") as outFile, \
+                    open(os.path.join(os.getcwd(), "pilot." + str(worker) + ".error"), "w") as errFile:
+                subprocess.Popen([sys.executable] + workerCommand, stdout=outFile, stderr=errFile)
     else:
-        myfile.write("\n")
+        nCoresPhysical = int(args.num_cores / 2)
+
+        fileName = 'pilotRun'
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores<=16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + args.pilot_walltime + "\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + args.pilot_walltime + "\n")
+        myfile.write("#OAR --array " + str(args.pilot_workers) + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/pilot.%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/pilot.%jobid%.error\n")
+
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write(" ".join(workerCommand) + "\n")
+
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
+
+        submit_oar_job(["oarsub","-n","pilot","-S",os.getcwd() + "/" + fileName])
+
+convergenceOptions = []
+if args.convergence_threshold > 0:
+    convergenceOptions = ["--convergence-threshold", str(args.convergence_threshold),
+                          "--convergence-displacement", str(args.convergence_displacement)]
+
+resolutionSchedule = [1]
+if args.resolution_schedule != "":
+    resolutionSchedule = [int(factor) for factor in args.resolution_schedule.split(",")]
+
+if min(resolutionSchedule) < 1 or sorted(resolutionSchedule, reverse=True) != resolutionSchedule:
+    print("Resolution schedule should be a non increasing list of integer downsampling factors")
+    sys.exit(1)
+
+initialRef = ref
+for factor in sorted(set(resolution_factor(resolutionSchedule, k) for k in range(1, args.num_iterations + 1))):
+    if factor == 1:
+        continue
 
-    myfile.close()
-    os.chmod(fileName, stat.S_IRWXU)
+    os.makedirs(level_folder(prefixBase, factor), exist_ok=True)
+    levelRef = level_reference(prefixBase, initialRef, filesExtension, factor)
+    if not os.path.exists(levelRef):
+        downsample_image(initialRef, levelRef, factor)
 
-    oarRunCommand = ["oarsub","-n","merge-" + str(k),"-S",os.getcwd() + "/mergeRun_" + str(k)]
+    for index in range(1, args.num_images + 1):
+        levelImage = os.path.join(level_folder(prefixBase, factor), prefix + "_" + str(index) + filesExtension)
+        if not os.path.exists(levelImage):
+            downsample_image(os.path.join(prefixBase, prefix + "_" + str(index) + filesExtension), levelImage, factor)
 
-    for jobId in jobsIds:
-        oarRunCommand += ["-a",jobId]
+ref = level_reference(prefixBase, initialRef, filesExtension, resolution_factor(resolutionSchedule, 1))
 
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            previousMergeId = statsLine.split("=")[1]
+if args.first_reuse_dir != "" and resolution_factor(resolutionSchedule, 1) != 1:
+    print("Transformations of the first iteration can only be reused when it runs at native resolution")
+    sys.exit(1)
+
+
+def tree_merge_stages():
+    # Stage, level and number of groups of the jobs of the tree reduction merge, in execution order
+    stages = []
+    for kind in ["transforms", "images"]:
+        level = 0
+        numGroups = int(math.ceil(args.num_images / args.merge_group_size))
+        stages += [(kind + "-map", level, numGroups)]
+        while numGroups > 1:
+            level += 1
+            numGroups = int(math.ceil(numGroups / args.merge_fan_in))
+            stages += [(kind + "-reduce", level, numGroups)]
+
+    return stages
+
+
+def tree_merge_command(num_it, level_prefix_base, num_cores, merge_options):
+    command = [os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalTreeMerge.py"),
+               "-d", os.getcwd(), "-B", level_prefix_base, "-p", prefix, "-i", str(num_it), "-n", str(args.num_images),
+               "-r", ref, "-e", filesExtension, "-c", str(num_cores),
+               "-G", str(args.merge_group_size), "-F", str(args.merge_fan_in)]
+    if not args.weights_file == "":
+        command += ["-w", args.weights_file]
+
+    return command + merge_options
+
+
+firstIteration = 1
+lastIteration = args.num_iterations
+if args.extend is True:
+    if args.resolution_schedule != "":
+        print("A resolution schedule cannot be used when extending an atlas")
+        sys.exit(1)
+
+    # Iteration of the existing atlas, kept in extendStore so that an interrupted extension can be resumed
+    extendBaseFile = os.path.join("extendStore", "base_iteration.txt")
+    baseIteration = 0
+    if os.path.exists(extendBaseFile):
+        baseIteration = int(open(extendBaseFile).read())
+        if os.path.exists('it_' + str(baseIteration + args.num_iterations) + '_done'):
+            baseIteration = 0
+
+    if baseIteration == 0:
+        doneIterations = [int(os.path.basename(f).split("_")[1]) for f in glob.glob("it_*_done")]
+        if len(doneIterations) == 0:
+            print("No existing atlas to extend in " + os.getcwd())
+            sys.exit(1)
+
+        baseIteration = max(doneIterations)
+        existingImages = [index for index in range(1, args.num_images + 1)
+                          if os.path.exists(os.path.join("tempDir", prefix + "_" + str(index) + "_nonlinear_tr.nrrd"))]
+        if len(existingImages) == 0:
+            print("Transformations of the last iteration of the existing atlas were not found in tempDir")
+            sys.exit(1)
+
+        if os.path.exists("extendStore"):
+            shutil.rmtree("extendStore")
+        os.makedirs("extendStore")
+
+        # Unbiasing transformation of the existing atlas, recomputed from the transformations of its last iteration
+        weights = read_weights(args.weights_file, args.num_images)
+        weightedSum, weightSum, header = accumulate_images([os.path.join("tempDir", prefix + "_" + str(index) + "_nonlinear_tr.nrrd") for index in existingImages],
+                                                           [weights[index - 1] for index in existingImages])
+        write_image(os.path.join("extendStore", "sumNonlinear_tr.nrrd"),
+                    normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+
+        command = [os.path.join(animaDir, "animaImageArithmetic"), "-i", os.path.join("extendStore", "sumNonlinear_tr.nrrd"),
+                   "-M", "-1", "-o", os.path.join("extendStore", "sumNonlinear_inv_tr.nrrd")]
+        subprocess.call(command)
+
+        # Transformations of existing images onto the existing average
+        for index in existingImages:
+            shutil.copy(os.path.join("tempDir", prefix + "_" + str(index) + "_linear_tr.txt"),
+                        os.path.join("extendStore", prefix + "_" + str(index) + "_linear_tr.txt"))
+
+            command = [os.path.join(animaDir, "animaDenseTransformArithmetic"),
+                       "-i", os.path.join("tempDir", prefix + "_" + str(index) + "_nonlinear_tr.nrrd"),
+                       "-c", os.path.join("extendStore", "sumNonlinear_inv_tr.nrrd"), "-b", str(args.bch_order),
+                       "-o", os.path.join("extendStore", prefix + "_" + str(index) + "_nonlinear_tr.nrrd")]
+            subprocess.call(command)
+
+        if os.path.exists(CONVERGED_MARKER):
+            os.remove(CONVERGED_MARKER)
+
+        myfile = open(extendBaseFile, "w")
+        myfile.write(str(baseIteration) + "\n")
+        myfile.close()
+
+    print("Extending atlas from averageForm" + str(baseIteration) + ".nrrd")
+    firstIteration = baseIteration + 1
+    lastIteration = baseIteration + args.num_iterations
+    ref = "averageForm" + str(baseIteration) + ".nrrd"
+    firstImage = 1
+
+for k in range(firstIteration, lastIteration + 1):
+    if os.path.exists('it_' + str(k) + '_done'):
+        ref = next_reference(resolutionSchedule, "averageForm", k, lastIteration)
+        firstImage = 1
+        continue
+
+    if os.path.exists(CONVERGED_MARKER):
+        print("Atlas converged before iteration " + str(k) + ", final average: " + ref)
+        break
+
+    print("*************Iteration " + str(k) + ", processing reference: " + ref)
+
+    for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag') + glob.glob("residualDir/" + prefix + '_*_failed'):
+        os.remove(f)
+
+    # Commit locks and folders of attempts left by an interrupted run
+    for f in glob.glob("tempDir/" + prefix + '_*_commit'):
+        os.remove(f)
+    for f in glob.glob("tempDir/" + prefix + '_*_attempt_*'):
+        shutil.rmtree(f)
+
+    # Transformations from an earlier run are not valid initializations for a new atlas
+    if k == 1 and os.path.exists("transformStore"):
+        shutil.rmtree("transformStore")
+
+    if k == 1 and args.ref_image == "":
+        numIt = 0
+    else:
+        numIt = k
+
+    factor = resolution_factor(resolutionSchedule, k)
+    levelPrefixBase = prefixBase
+    if factor > 1:
+        levelPrefixBase = level_folder(prefixBase, factor)
+
+    # Convergence is only checked at native resolution, the schedule being non increasing
+    mergeOptions = []
+    if factor == 1:
+        mergeOptions += convergenceOptions
+    nextRef = next_reference(resolutionSchedule, "averageForm", k, lastIteration)
+    if nextRef != "averageForm" + str(k) + ".nrrd":
+        mergeOptions += ["--next-ref", nextRef, "--next-ref-geometry",
+                         level_reference(prefixBase, initialRef, filesExtension, resolution_factor(resolutionSchedule, k + 1))]
+
+    if args.executor in ["local", "pilot"]:
+        registrationCommands = []
+        registrationLogs = []
+        for index in range(firstImage, args.num_images + 1):
+            command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py"),
+                       "-d", os.getcwd(), "-r", ref, "-B", levelPrefixBase, "-p", prefix, "-e", filesExtension,
+                       "-n", str(index), "-b", str(args.bch_order), "-c", str(args.num_cores)]
+            if args.rigid is True:
+                command += ["--rigid"]
+            if args.warm_start is True:
+                command += ["--warm-start"]
+            if args.lazy_tolerance > 0:
+                command += ["--lazy-tolerance", str(args.lazy_tolerance)]
+            if args.extend is True and k == firstIteration:
+                command += ["--reuse-dir", os.path.join(os.getcwd(), "extendStore")]
+            elif args.first_reuse_dir != "" and k == 1:
+                command += ["--reuse-dir", os.path.abspath(args.first_reuse_dir)]
+            if args.straggler_factor > 0:
+                command += ["--speculative"]
+
+            registrationCommands += [command]
+            registrationLogs += [os.path.join(os.getcwd(), "reg-" + str(k) + "." + str(index))]
+
+        returnCodes = execute_jobs(registrationCommands, registrationLogs,
+                                   ["reg-" + str(k) + "." + str(index) for index in range(firstImage, args.num_images + 1)],
+                                   args.straggler_factor)
+
+        failedImages = []
+        for index, returnCode in zip(range(firstImage, args.num_images + 1), returnCodes):
+            if returnCode != 0 or not os.path.exists(os.path.join("residualDir", prefix + "_" + str(index) + "_flag")):
+                failedImages += [str(index)]
+
+        if len(failedImages) > 0:
+            print("Registration failed for images " + " ".join(failedImages) + " at iteration " + str(k) + ", see reg-" + str(k) + ".*.error")
+            sys.exit(1)
+
+        if args.merge_group_size > 0:
+            # Tree reduction merge: stages run one after the other, groups of a stage in parallel
+            returnCode = 0
+            for stage, level, numGroups in tree_merge_stages():
+                commands = [[sys.executable] + tree_merge_command(numIt, levelPrefixBase, args.num_cores, mergeOptions) +
+                            ["-s", stage, "-l", str(level), "-g", str(group)] for group in range(1, numGroups + 1)]
+                logs = [os.path.join(os.getcwd(), "merge-" + str(k) + "-" + stage + "-" + str(level) + "." + str(group))
+                        for group in range(1, numGroups + 1)]
+                returnCodes = execute_jobs(commands, logs, [os.path.basename(log) for log in logs])
+                if max(returnCodes) != 0:
+                    returnCode = max(returnCodes)
+                    break
+        else:
+            # Pilot workers have -c cores each, the local merge uses all of them
+            mergeCores = localCores
+            if args.executor == "pilot":
+                mergeCores = args.num_cores
+
+            command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalMergeImages.py"),
+                       "-d", os.getcwd(), "-B", levelPrefixBase, "-p", prefix, "-i", str(numIt), "-n", str(args.num_images),
+                       "-r", ref, "-e", filesExtension, "-c", str(mergeCores)]
+            if not args.weights_file == "":
+                command += ["-w", args.weights_file]
+            command += mergeOptions
+
+            returnCode = execute_jobs([command], [os.path.join(os.getcwd(), "merge-" + str(k))], ["merge-" + str(k)])[0]
+
+        if returnCode != 0 or not os.path.exists('it_' + str(k) + '_done'):
+            print("Merge failed at iteration " + str(k) + ", see merge-" + str(k) + "*.error")
+            sys.exit(1)
+
+        if os.path.exists(CONVERGED_MARKER):
+            print("Atlas converged at iteration " + str(k) + ", final average: averageForm" + str(k) + ".nrrd")
             break
 
-    ref = "averageForm" + str(k) + ".nrrd"
+        # Same clean-up as the one performed by the merge step when the next iteration is already scheduled on OAR
+        if k < lastIteration:
+            shutil.rmtree("residualDir")
+            shutil.rmtree("tempDir")
+            os.makedirs('tempDir')
+            os.makedirs('residualDir')
+    else:
+        numJobs = args.num_images - firstImage + 1
+        nCoresPhysical = int(args.num_cores / 2)
+
+        fileName = 'iterRun_' + str(k)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores<=16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+        myfile.write("#OAR --array " + str(numJobs) + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
+
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write("if [ -e " + CONVERGED_MARKER + " ]; then exit 0; fi\n")
+
+        if k == 1 and args.ref_image == "":
+            myfile.write("let index=${OAR_ARRAY_INDEX}+1\n")
+            myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py") +
+                         " -d " + os.getcwd() + " -r " + ref + " -B " + levelPrefixBase + " -p " + prefix + " -e " + filesExtension +
+                         " -n $index -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+        else:
+            myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py") +
+                         " -d " + os.getcwd() + " -r " + ref + " -B " + levelPrefixBase + " -p " + prefix + " -e " + filesExtension +
+                         " -n $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+
+        if args.rigid is True:
+            myfile.write(" --rigid")
+        if args.warm_start is True:
+            myfile.write(" --warm-start")
+        if args.lazy_tolerance > 0:
+            myfile.write(" --lazy-tolerance " + str(args.lazy_tolerance))
+        if args.extend is True and k == firstIteration:
+            myfile.write(" --reuse-dir " + os.path.join(os.getcwd(), "extendStore"))
+        elif args.first_reuse_dir != "" and k == 1:
+            myfile.write(" --reuse-dir " + os.path.abspath(args.first_reuse_dir))
+        myfile.write("\n")
+
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
+
+        oarRunCommand = ["oarsub"]
+        if previousMergeId == 0:
+            oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/iterRun_" + str(k)]
+        else:
+            oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/iterRun_" + str(k)]
+
+        jobsIds = submit_oar_job(oarRunCommand)
+
+        if args.merge_group_size > 0:
+            # Tree reduction merge: one OAR array job per stage, each depending on the previous one
+            for stage, level, numGroups in tree_merge_stages():
+                fileName = 'mergeRun_' + str(k) + "_" + stage + "_" + str(level)
+                myfile = open(fileName,"w")
+                myfile.write("#!/bin/bash\n")
+                if args.num_cores<=16:
+                    myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
+                myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+                myfile.write("#OAR --array " + str(numGroups) + "\n")
+                myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + "-" + stage + "-" + str(level) + ".%jobid%.output\n")
+                myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + "-" + stage + "-" + str(level) + ".%jobid%.error\n")
+
+                myfile.write("cd " + os.getcwd() + "\n")
+                myfile.write("if [ -e " + CONVERGED_MARKER + " ]; then exit 0; fi\n")
+                myfile.write(" ".join(tree_merge_command(numIt, levelPrefixBase, args.num_cores, mergeOptions) +
+                                      ["-s", stage, "-l", str(level), "-g", "$OAR_ARRAY_INDEX"]) + "\n")
+
+                myfile.close()
+                os.chmod(fileName, stat.S_IRWXU)
+
+                oarRunCommand = ["oarsub","-n","merge-" + str(k) + "-" + stage + "-" + str(level),"-S",os.getcwd() + "/" + fileName]
+                for jobId in jobsIds:
+                    oarRunCommand += ["-a",jobId]
+
+                jobsIds = submit_oar_job(oarRunCommand)
+
+            # The last reduction has a single group
+            previousMergeId = jobsIds[0]
+        else:
+            fileName = 'mergeRun_' + str(k)
+            myfile = open(fileName,"w")
+            myfile.write("#!/bin/bash\n")
+            if args.num_cores<=16:
+                myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
+            myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+            myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.output\n")
+            myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.error\n")
+
+            myfile.write("cd " + os.getcwd() + "\n")
+            myfile.write("if [ -e " + CONVERGED_MARKER + " ]; then exit 0; fi\n")
+            myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalMergeImages.py") +
+                         " -d " + os.getcwd() + " -B " + levelPrefixBase + " -p " + prefix + " -i " + str(numIt) +
+                         " -n " + str(args.num_images) + " -r " + ref + " -e " + filesExtension + " -c " + str(args.num_cores))
+
+            if not args.weights_file == "":
+                myfile.write(" -w " + args.weights_file)
+
+            if len(mergeOptions) > 0:
+                myfile.write(" " + " ".join(mergeOptions))
+            myfile.write("\n")
+
+            myfile.close()
+            os.chmod(fileName, stat.S_IRWXU)
+
+            oarRunCommand = ["oarsub","-n","merge-" + str(k),"-S",os.getcwd() + "/mergeRun_" + str(k)]
+
+            for jobId in jobsIds:
+                oarRunCommand += ["-a",jobId]
+
+            previousMergeId = submit_oar_job(oarRunCommand)[0]
+
+    ref = next_reference(resolutionSchedule, "averageForm", k, lastIteration)
     firstImage = 1
@@ -4,6 +4,7 @@
 import argparse
 import os
 import glob
+import math
 import stat
 import sys
 import subprocess
@@ -34,6 +35,15 @@ parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of co
 parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations (default: 2)')
 parser.add_argument('-s', '--start', type=int, default=1, help='number of images in the starting atlas (default: 1)')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--batch-size', type=int, default=1,
+                    help='Number of images incorporated at each step, registered in parallel on the same average (default: 1)')
+parser.add_argument('--materialize-every', type=int, default=1,
+                    help='Number of steps between exact averages: in between, previous images are not recomposed nor '
+                         'warped and the previous average warped by the centroid update stands for them (default: 1, '
+                         'exact average at each step)')
+parser.add_argument('--hierarchical', action='store_true',
+                    help='Divide and conquer construction: centroids of pairs of disjoint groups of images are merged, '
+                         'weighted by group sizes, level by level in parallel (logarithmic depth, masks are not used)')
 
 args = parser.parse_args()
 
@@ -54,13 +64,76 @@ if args.start == 1 or args.start == 0:
 
 previousMergeId = 0
 
-for k in range(args.start + 1, args.num_images + 1):
+if args.hierarchical is True:
+    if args.start > 1:
+        print("A hierarchical atlas cannot be built from a starting atlas")
+        sys.exit(1)
+
+    if not os.path.exists('hierarchyDir'):
+        os.makedirs('hierarchyDir')
+
+    # One OAR array job per level of the tree, nodes of a level being built in parallel once the previous level is done
+    nCoresPhysical = int(args.num_cores / 2)
+    jobsIds = []
+    level = 0
+    while int(math.ceil(args.num_images / 2 ** level)) > 1:
+        level += 1
+        numNodes = int(math.ceil(args.num_images / 2 ** level))
+
+        fileName = 'nodeRun_' + str(level)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores<=16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+        myfile.write("#OAR --array " + str(numNodes) + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/node-" + str(level) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/node-" + str(level) + ".%jobid%.error\n")
+
+        myfile.write("cd " + os.getcwd() + "\n")
+
+        myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalMergeCentroids.py") +
+                     " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -n " + str(args.num_images) +
+                     " -l " + str(level) + " -g $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+
+        if args.rigid is True:
+            myfile.write(" --rigid\n")
+        else:
+            myfile.write("\n")
+
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
+
+        oarRunCommand = ["oarsub","-n","node-" + str(level),"-S", os.getcwd() + "/" + fileName]
+        for jobId in jobsIds:
+            oarRunCommand += ["-a",jobId]
+
+        jobsIds = []
+        procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+        statLines = procStat.stdout.decode('utf-8').split('\n')
+        for statsLine in statLines:
+            if "OAR_JOB_ID" in statsLine:
+                jobsIds += [statsLine.split("=")[1]]
+
+    sys.exit(0)
+
+# Steps since the last exact average: centroid updates of these steps are composed only when the next exact average is
+# built, each previous image being recomposed and warped once instead of at every step
+chainSteps = [args.start]
+
+for firstImage in range(args.start + 1, args.num_images + 1, args.batch_size):
+    k = min(firstImage + args.batch_size - 1, args.num_images)
+    chainSteps += [k]
+    materialize = len(chainSteps) > args.materialize_every or k == args.num_images
+    chainArg = ",".join(str(step) for step in chainSteps)
+    if materialize:
+        chainSteps = [k]
+
     if os.path.exists('it_' + str(k) + '_done'):
-        firstImage = 1
         continue
-    ref = "averageForm" + str(k-1)
+    ref = "averageForm" + str(firstImage-1)
 
-    print("*************Incorporating image: " + str(k) + " in atlas: " + ref)
+    print("*************Incorporating images: " + str(firstImage) + " to " + str(k) + " in atlas: " + ref)
 
     for f in glob.glob("residualDir/" + prefix + '_*_nl_tr.nii.gz') + glob.glob("residualDir/" + prefix + '_*_flag'):
         os.remove(f)
@@ -73,13 +146,15 @@ for k in range(args.start + 1, args.num_images + 1):
     if args.num_cores<=16:
         myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
     myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+    myfile.write("#OAR --array " + str(k - firstImage + 1) + "\n")
     myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
     myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
 
     myfile.write("cd " + os.getcwd() + "\n")
+    myfile.write("let index=${OAR_ARRAY_INDEX}+" + str(firstImage - 1) + "\n")
 
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalRegisterImage.py") +
-                 " -d " + os.getcwd() + " -r " + ref + ".nii.gz -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
+                 " -d " + os.getcwd() + " -r " + ref + ".nii.gz -B " + prefixBase + " -p " + prefix + " -i $index" +
                  " -b " + str(args.bch_order) + " -c " + str(args.num_cores))
 
     if args.rigid is True:
@@ -96,14 +171,51 @@ for k in range(args.start + 1, args.num_images + 1):
     else:
         oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/regRun_" + str(k)]
 
+    jobsIds = []
+    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+    statLines = procStat.stdout.decode('utf-8').split('\n')
+    for statsLine in statLines:
+        if "OAR_JOB_ID" in statsLine:
+            jobsIds += [statsLine.split("=")[1]]
+
+    fileName = 'updateRun_' + str(k)
+    myfile = open(fileName,"w")
+    myfile.write("#!/bin/bash\n")
+    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+    myfile.write("#OAR -O " + os.getcwd() + "/update-" + str(k) + ".%jobid%.output\n")
+    myfile.write("#OAR -E " + os.getcwd() + "/update-" + str(k) + ".%jobid%.error\n")
+
+    myfile.write("cd " + os.getcwd() + "\n")
+
+    myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalUpdateCentroid.py") +
+                 " -d " + os.getcwd() + " -p " + prefix + " -f " + str(firstImage) + " -i " + str(k) +
+                 " -b " + str(args.bch_order) + " --chain-steps " + chainArg)
+
+    if materialize:
+        myfile.write(" --materialize\n")
+    else:
+        myfile.write("\n")
+
+    myfile.close()
+    os.chmod(fileName, stat.S_IRWXU)
+
+    oarRunCommand = ["oarsub"]
+    for jobId in jobsIds:
+        oarRunCommand += ["-a",jobId]
+    oarRunCommand += ["-n","update-" + str(k),"-S", os.getcwd() + "/updateRun_" + str(k)]
+
     procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
     statLines = procStat.stdout.decode('utf-8').split('\n')
     for statsLine in statLines:
         if "OAR_JOB_ID" in statsLine:
-            previousRegId = statsLine.split("=")[1]
+            previousUpdateId = statsLine.split("=")[1]
             break
 
-    numJobs = k
+    # All images are recomposed and warped for an exact average, only the batch images otherwise
+    firstWarped = 1
+    if not materialize:
+        firstWarped = firstImage
+    numJobs = k - firstWarped + 1
 
     fileName = 'bchRun_' + str(k)
     myfile = open(fileName,"w")
@@ -116,16 +228,17 @@ for k in range(args.start + 1, args.num_images + 1):
     myfile.write("#OAR -E " + os.getcwd() + "/bch-" + str(k) + ".%jobid%.error\n")
 
     myfile.write("cd " + os.getcwd() + "\n")
+    myfile.write("let index=${OAR_ARRAY_INDEX}+" + str(firstWarped - 1) + "\n")
 
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalComposeTransformations.py") +
                  " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
                  " -c " + str(args.num_cores) + " -s " + str(args.start) + " -b " + str(args.bch_order) +
-                 " -a $OAR_ARRAY_INDEX \n")
+                 " -f " + str(firstImage) + " --chain-steps " + chainArg + " -a $index \n")
 
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub","-n","bch-" + str(k),"-S",os.getcwd() + "/bchRun_" + str(k), "-a", str(previousRegId)]
+    oarRunCommand = ["oarsub","-n","bch-" + str(k),"-S",os.getcwd() + "/bchRun_" + str(k), "-a", str(previousUpdateId)]
     
     jobsIds = []
     procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
@@ -147,7 +260,12 @@ for k in range(args.start + 1, args.num_images + 1):
 
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalMergeImages.py") +
                  " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
-                 " -c " + str(args.num_cores) + "\n")
+                 " -c " + str(args.num_cores) + " -f " + str(firstImage))
+
+    if materialize:
+        myfile.write("\n")
+    else:
+        myfile.write(" --approximate\n")
 
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
@@ -22,6 +22,10 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,6 +38,10 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
 parser.add_argument('-s', '--start', type=int, default=1, help='Number of images in the starting atlas (default: 1)')
+parser.add_argument('-f', '--first-image', type=int, required=True, help='First image of the batch incorporated at this step')
+parser.add_argument('--chain-steps', type=str, required=True,
+                    help='Comma separated numbers of images in the atlas at the last exact average and after each step since '
+                         'then, the last one being num-iter')
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
@@ -42,30 +50,37 @@ k=args.num_iter
 a=args.num_img
 
 animaImageArithmetic = os.path.join(animaDir,"animaImageArithmetic")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
 animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
 animaCreateImage = os.path.join(animaDir,"animaCreateImage")
 animaLinearTransformArithmetic = os.path.join(animaDir,"animaLinearTransformArithmetic")
 
-if a==1 and k==2:
+chainSteps = [int(step) for step in args.chain_steps.split(",")]
+
+# Step at which thetak_a was last brought to the current centroid: the last exact average, or the step incorporating a
+lastStep = chainSteps[0]
+if a > chainSteps[0]:
+    lastStep = min(step for step in chainSteps if step >= a)
+
+if a==1 and chainSteps[0]==1:
     command = [animaCreateImage,"-g", "averageForm1.nii.gz", "-v", "3", "-b", "0", "-o", "tempDir/thetak_1.nii.gz"]
     call(command)
     command= [animaLinearTransformArithmetic, "-i", os.path.join("tempDir",args.prefix + "_2_linear_tr.txt"), "-M", "0", "-o", os.path.join("tempDir",args.prefix + "_1_linear_tr.txt")]
     call(command)
 
-if a < k:
-    command = [animaDenseTransformArithmetic,"-i",os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz"), "-c", os.path.join("tempDir", "Tk.nii.gz"), "-b", str(args.bch_order), "-o", os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz")]
+if lastStep < k:
+    command = [animaDenseTransformArithmetic,"-i",os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz"), "-c", os.path.join("tempDir", "Sk_" + str(lastStep) + ".nii.gz"), "-b", str(args.bch_order), "-o", os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz")]
     call(command)
 
-command = [animaTransformSerieXmlGenerator,"-i", os.path.join("tempDir",args.prefix + "_" + str(a) + "_linear_tr.txt"), "-i", os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz"), "-o", os.path.join("tempDir", "T_" + str(a) + ".xml") ]
-call(command)
+write_transform_serie_xml([os.path.join("tempDir",args.prefix + "_" + str(a) + "_linear_tr.txt"),
+                           os.path.join("tempDir", "thetak_" + str(a) + ".nii.gz")],
+                          os.path.join("tempDir", "T_" + str(a) + ".xml"))
 
-command = [animaApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(a) + ".nii.gz"),"-t",os.path.join("tempDir", "T_" + str(a) + ".xml"),"-g","averageForm" + str(k-1) + ".nii.gz", "-o",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nii.gz"),"-p",str(args.num_cores)]
+command = [animaApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(a) + ".nii.gz"),"-t",os.path.join("tempDir", "T_" + str(a) + ".xml"),"-g","averageForm" + str(args.first_image-1) + ".nii.gz", "-o",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nii.gz"),"-p",str(args.num_cores)]
 call(command)
 
 if os.path.exists(os.path.join("Masks", "Mask_" + str(a) + ".nii.gz")):
-    command = [animaApplyTransformSerie,"-i",os.path.join("Masks", "Mask_" + str(a) + ".nii.gz"),"-t",os.path.join("tempDir", "T_" + str(a) + ".xml"),"-g","averageForm" + str(k-1) + ".nii.gz", "-o",os.path.join("tempDir","Mask_" + str(a) + "_at.nii.gz"),"-p",str(args.num_cores),"-n","nearest"]
+    command = [animaApplyTransformSerie,"-i",os.path.join("Masks", "Mask_" + str(a) + ".nii.gz"),"-t",os.path.join("tempDir", "T_" + str(a) + ".xml"),"-g","averageForm" + str(args.first_image-1) + ".nii.gz", "-o",os.path.join("tempDir","Mask_" + str(a) + "_at.nii.gz"),"-p",str(args.num_cores),"-n","nearest"]
     call(command)
 
    
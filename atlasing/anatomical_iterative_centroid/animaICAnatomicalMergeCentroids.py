@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaICAnatomicalMergeCentroids.py ..." has to be run
+
+import argparse
+import math
+import os
+import sys
+from subprocess import call
+import shutil
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+if not os.path.exists(configFilePath):
+    print('Please create a configuration file for Anima python scripts. Refer to the README')
+    quit()
+
+configParser = ConfParser.RawConfigParser()
+configParser.read(configFilePath)
+
+animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaImageAveraging import accumulate_images, normalize_sum, output_dtype
+from animaImageIO import read_image, write_image
+from animaTransformSerieXml import write_transform_serie_xml
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Builds one node of a hierarchical centroid atlas: the centroids of two disjoint groups of images (the "
+                "images themselves at the first level) are merged by registering the second one on the first one and "
+                "moving both to their centroid, weighted by group sizes.")
+parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
+parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix base')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
+parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images in the atlas')
+parser.add_argument('-l', '--level', type=int, required=True, help='Level of the node (from 1, images being level 0)')
+parser.add_argument('-g', '--group', type=int, required=True, help='Node number in its level (from 1, e.g. the OAR array index)')
+parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations in rigid unbiased (default: 2)')
+parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+
+args = parser.parse_args()
+os.chdir(args.ref_dir)
+
+animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
+
+
+def num_nodes(level):
+    return int(math.ceil(args.num_images / 2 ** level))
+
+
+def group_size(level, group):
+    return min(group * 2 ** level, args.num_images) - (group - 1) * 2 ** level
+
+
+def centroid_file(level, group):
+    if level == 0:
+        return os.path.abspath(os.path.join(args.prefix_base, args.prefix + "_" + str(group) + ".nii.gz"))
+
+    return os.path.join(os.getcwd(), "hierarchyDir", "centroid_" + str(level) + "_" + str(group) + ".nii.gz")
+
+
+outputFile = centroid_file(args.level, args.group)
+firstChild = centroid_file(args.level - 1, 2 * args.group - 1)
+
+if 2 * args.group > num_nodes(args.level - 1):
+    # Odd node of its level, carried to the next one
+    shutil.copyfile(firstChild, outputFile)
+else:
+    secondChild = centroid_file(args.level - 1, 2 * args.group)
+    firstSize = group_size(args.level - 1, 2 * args.group - 1)
+    secondSize = group_size(args.level - 1, 2 * args.group)
+
+    # The second centroid is registered on the first one as image 2 of a node folder
+    nodeDir = os.path.join(os.getcwd(), "hierarchyDir", "node_" + str(args.level) + "_" + str(args.group))
+    for folder in ["data", "tempDir", "residualDir"]:
+        if not os.path.exists(os.path.join(nodeDir, folder)):
+            os.makedirs(os.path.join(nodeDir, folder))
+
+    if os.path.lexists(os.path.join(nodeDir, "data", "centroid_2.nii.gz")):
+        os.remove(os.path.join(nodeDir, "data", "centroid_2.nii.gz"))
+    os.symlink(secondChild, os.path.join(nodeDir, "data", "centroid_2.nii.gz"))
+
+    command = [os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalRegisterImage.py"),
+               "-d", nodeDir, "-r", firstChild, "-B", os.path.join(nodeDir, "data"), "-p", "centroid", "-i", "2",
+               "-b", str(args.bch_order), "-c", str(args.num_cores)]
+    if args.rigid is True:
+        command += ["--rigid"]
+    call(command)
+
+    # Same centroid update as incorporating a batch of secondSize images in an atlas of firstSize images
+    nonlinear, header = read_image(os.path.join(nodeDir, "tempDir", "centroid_2_nonlinear_tr.nii.gz"))
+    update = -secondSize / (firstSize + secondSize) * nonlinear
+    write_image(os.path.join(nodeDir, "tempDir", "Tk.nii.gz"), update.astype(output_dtype(header)), header)
+    write_image(os.path.join(nodeDir, "tempDir", "thetak_2.nii.gz"), (nonlinear + update).astype(output_dtype(header)),
+                header)
+
+    write_transform_serie_xml([os.path.join(nodeDir, "tempDir", "Tk.nii.gz")], os.path.join(nodeDir, "tempDir", "T_1.xml"))
+    write_transform_serie_xml([os.path.join(nodeDir, "tempDir", "centroid_2_linear_tr.txt"),
+                               os.path.join(nodeDir, "tempDir", "thetak_2.nii.gz")],
+                              os.path.join(nodeDir, "tempDir", "T_2.xml"))
+
+    command = [animaApplyTransformSerie, "-i", firstChild, "-t", os.path.join(nodeDir, "tempDir", "T_1.xml"), "-g", firstChild,
+               "-o", os.path.join(nodeDir, "tempDir", "centroid_1_at.nii.gz"), "-p", str(args.num_cores)]
+    call(command)
+    command = [animaApplyTransformSerie, "-i", secondChild, "-t", os.path.join(nodeDir, "tempDir", "T_2.xml"), "-g", firstChild,
+               "-o", os.path.join(nodeDir, "tempDir", "centroid_2_at.nii.gz"), "-p", str(args.num_cores)]
+    call(command)
+
+    weightedSum, weightSum, header = accumulate_images([os.path.join(nodeDir, "tempDir", "centroid_1_at.nii.gz"),
+                                                        os.path.join(nodeDir, "tempDir", "centroid_2_at.nii.gz")],
+                                                       [float(firstSize), float(secondSize)])
+    write_image(outputFile, normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+
+if num_nodes(args.level) == 1:
+    # Root of the tree: same output as the image by image construction
+    shutil.copyfile(outputFile, "averageForm" + str(args.num_images) + ".nii.gz")
@@ -22,6 +22,12 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaImageAveraging import accumulate_images, normalize_sum, output_dtype
+from animaImageIO import write_image
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -31,11 +37,34 @@ parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix
 parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('-f', '--first-image', type=int, default=0, help='First image of the batch incorporated at this step (default: num-iter)')
+parser.add_argument('--approximate', action='store_true',
+                    help='Only the batch images were warped: the previous average, warped by the centroid update, stands '
+                         'for the previous images (masks are not used)')
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 
 animaAverageImages = os.path.join(animaDir,"animaAverageImages")
+animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
+
+k = args.num_iter
+firstImage = args.first_image
+if firstImage == 0:
+    firstImage = k
+
+if args.approximate is True:
+    previousAverage = "averageForm" + str(firstImage - 1) + ".nii.gz"
+    write_transform_serie_xml([os.path.join("tempDir", "Tk_" + str(k) + ".nii.gz")], os.path.join("tempDir", "T_average.xml"))
+    command = [animaApplyTransformSerie, "-i", previousAverage, "-t", os.path.join("tempDir", "T_average.xml"), "-g",
+               previousAverage, "-o", os.path.join("tempDir", "averageForm_at.nii.gz"), "-p", str(args.num_cores)]
+    call(command)
+
+    imageFiles = [os.path.join("tempDir", "averageForm_at.nii.gz")]
+    imageFiles += [os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nii.gz") for a in range(firstImage, k + 1)]
+    weightedSum, weightSum, header = accumulate_images(imageFiles, [firstImage - 1.0] + [1.0] * (k + 1 - firstImage))
+    write_image("averageForm" + str(k) + ".nii.gz", normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+    sys.exit(0)
 
 myfile = open("avgImg.txt","w")
 myfileMasks = open("masksIms.txt","w")
@@ -24,7 +24,8 @@ animaDir = configParser.get("anima-scripts", 'anima')
 
 # Argument parsing
 parser = argparse.ArgumentParser(
-    description="Runs the registration of an image onto a current reference (to be used from build anatomical atlas).")
+    description="Runs the registration of an image onto a current reference (to be used from build anatomical atlas). The "
+                "centroid update is then computed by animaICAnatomicalUpdateCentroid.py.")
 parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
 parser.add_argument('-r', '--ref-image', type=str, required=True, help='Reference image')
 parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix base')
@@ -42,7 +43,6 @@ k=args.num_iter
 
 animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
 animaDenseSVFBMRegistration = os.path.join(animaDir,"animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaLinearTransformArithmetic = os.path.join(animaDir,"animaLinearTransformArithmetic")
 animaLinearTransformToSVF = os.path.join(animaDir,"animaLinearTransformToSVF")
 animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
@@ -106,11 +106,3 @@ if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(k)
 if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(k) + "_linearaddon_tr.nii.gz")):
     os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(k) + "_linearaddon_tr.nii.gz"))
 
-
-wk=-1.0/k
-command = [animaImageArithmetic, "-i", os.path.join("tempDir",args.prefix + "_" + str(k) + "_nonlinear_tr.nii.gz"),"-M",str(wk),"-o",os.path.join("tempDir","Tk.nii.gz")]
-call(command)
-wkk=(k-1.0)/k
-command = [animaImageArithmetic, "-i", os.path.join("tempDir",args.prefix + "_" + str(k) + "_nonlinear_tr.nii.gz"),"-M",str(wkk),"-o",os.path.join("tempDir","thetak_" + str(k) +".nii.gz")]
-call(command)
-
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaICAnatomicalUpdateCentroid.py ..." has to be run
+
+import argparse
+import glob
+import os
+import re
+import shutil
+import sys
+from subprocess import call
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+if not os.path.exists(configFilePath):
+    print('Please create a configuration file for Anima python scripts. Refer to the README')
+    quit()
+
+configParser = ConfParser.RawConfigParser()
+configParser.read(configFilePath)
+
+animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaImageAveraging import accumulate_images, output_dtype
+from animaImageIO import read_image, write_image
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Updates the centroid with a batch of registered images (first-image to num-iter): computes the centroid "
+                "update Tk_<num-iter> and the transformations thetak of the batch images. When an exact average is to be "
+                "built, also composes the centroid updates not yet applied to previous images.")
+parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
+parser.add_argument('-f', '--first-image', type=int, required=True, help='First image of the batch')
+parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation (last image of the batch)')
+parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations (default: 2)')
+parser.add_argument('--chain-steps', type=str, required=True,
+                    help='Comma separated numbers of images in the atlas at the last exact average and after each step since '
+                         'then, the last one being num-iter')
+parser.add_argument('--materialize', action='store_true',
+                    help='Compose the centroid updates of the chain for the exact average of this step')
+
+args = parser.parse_args()
+os.chdir(args.ref_dir)
+
+k = args.num_iter
+chainSteps = [int(step) for step in args.chain_steps.split(",")]
+
+animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
+
+# Centroid update: each image of the batch moves the centroid of 1/k of its transformation, as in the one image case
+batchImages = list(range(args.first_image, k + 1))
+nonlinearFiles = [os.path.join("tempDir", args.prefix + "_" + str(a) + "_nonlinear_tr.nii.gz") for a in batchImages]
+weightedSum, _, header = accumulate_images(nonlinearFiles, [1.0] * len(batchImages))
+update = -weightedSum / k
+write_image(os.path.join("tempDir", "Tk_" + str(k) + ".nii.gz"), update.astype(output_dtype(header)), header)
+
+for a in range(len(batchImages)):
+    nonlinear, nonlinearHeader = read_image(nonlinearFiles[a])
+    write_image(os.path.join("tempDir", "thetak_" + str(batchImages[a]) + ".nii.gz"),
+                (nonlinear + update).astype(output_dtype(nonlinearHeader)), nonlinearHeader)
+
+# Updates already applied to all images are not needed anymore
+for f in glob.glob(os.path.join("tempDir", "Tk_*.nii.gz")) + glob.glob(os.path.join("tempDir", "Sk_*.nii.gz")):
+    step = int(re.search(r"_(\d+)\.nii\.gz$", f).group(1))
+    if step < chainSteps[0] or (step == chainSteps[0] and os.path.basename(f).startswith("Tk_")):
+        os.remove(f)
+
+if args.materialize is True:
+    # Sk_s: composition of the updates following step s, for images last composed at step s. Built backwards from the
+    # last update so that each image is composed once, whatever the number of steps since the last exact average
+    shutil.copyfile(os.path.join("tempDir", "Tk_" + str(k) + ".nii.gz"),
+                    os.path.join("tempDir", "Sk_" + str(chainSteps[-2]) + ".nii.gz"))
+    for i in range(len(chainSteps) - 3, -1, -1):
+        command = [animaDenseTransformArithmetic, "-i", os.path.join("tempDir", "Tk_" + str(chainSteps[i + 1]) + ".nii.gz"),
+                   "-c", os.path.join("tempDir", "Sk_" + str(chainSteps[i + 1]) + ".nii.gz"), "-b", str(args.bch_order),
+                   "-o", os.path.join("tempDir", "Sk_" + str(chainSteps[i]) + ".nii.gz")]
+        call(command)
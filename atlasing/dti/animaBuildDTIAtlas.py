@@ -25,9 +25,15 @@ configParser.read(configFilePath)
 animaDir = configParser.get("anima-scripts", 'anima')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaAtlasConvergence import CONVERGED_MARKER
+from animaImageResampling import downsample_image
+from animaResolutionSchedule import level_folder, level_reference, next_reference, resolution_factor
+from animaLocalExecutor import get_local_cores, run_job, run_jobs
+
 # Argument parsing
 parser = argparse.ArgumentParser(
-    description="Builds and runs a series of scripts on an OAR cluster to construct a DTI atlas (unbiased up to an affine or rigid transform, with different or equal weights).")
+    description="Builds and runs a series of scripts on an OAR cluster (or on the local machine) to construct a DTI atlas (unbiased up to an affine or rigid transform, with different or equal weights).")
 parser.add_argument('-p', '--data-prefix', type=str, required=True, help='Data prefix (including folder)')
 parser.add_argument('-i', '--num-iterations', type=int, default=8, help='Number of iterations (default: 8)')
 parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images in the atlas')
@@ -36,6 +42,19 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-w', '--weights-file', type=str, default="", help='Link to weights file if needed, otherwise using equal weights (default: none)')
 parser.add_argument('-r', '--ref-image', type=str, default="", help='Reference image for the first round of registrations')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Initialize each registration from the transformations of the same image at the previous iteration")
+parser.add_argument('--resolution-schedule', type=str, default="",
+                    help='Comma separated, non increasing downsampling factors of the iterations, the last one being used for '
+                         'remaining iterations, e.g. 2,2,1 (default: native resolution for all iterations)')
+parser.add_argument('--executor', type=str, default="oar", choices=["oar", "local"],
+                    help='Run registrations and merges as OAR jobs or as a local process pool (default: oar)')
+parser.add_argument('--local-cores', type=int, default=0,
+                    help='Total number of cores used by the local executor (default: all available cores)')
+parser.add_argument('--convergence-threshold', type=float, default=0,
+                    help='Stop iterating once the relative change of the average falls below this threshold (default: 0, run all iterations)')
+parser.add_argument('--convergence-displacement', type=float, default=0.1,
+                    help='Maximal RMS norm (in mm) of the mean transformation for the atlas to be considered converged (default: 0.1)')
 
 args = parser.parse_args()
 
@@ -68,106 +87,217 @@ if filesExtension == "":
     refBasename = os.path.basename(ref)
     filesList = os.listdir(prefixBase)
     for f in filesList:
-        if refBasename in f:
+        # Only the reference itself, not maps derived from it (e.g. <prefix>_1_ADC.nrrd left by earlier versions)
+        if f.startswith(refBasename + "."):
             filesExtension = os.path.splitext(f)[1]
             if filesExtension == '.gz':
                 filesExtension = os.path.splitext(os.path.splitext(f)[0])[1] + filesExtension
 
 previousMergeId = 0
 ref = ref + filesExtension
+localCores = get_local_cores(args.local_cores)
+
+convergenceOptions = []
+if args.convergence_threshold > 0:
+    convergenceOptions = ["--convergence-threshold", str(args.convergence_threshold),
+                          "--convergence-displacement", str(args.convergence_displacement)]
+
+resolutionSchedule = [1]
+if args.resolution_schedule != "":
+    resolutionSchedule = [int(factor) for factor in args.resolution_schedule.split(",")]
+
+if min(resolutionSchedule) < 1 or sorted(resolutionSchedule, reverse=True) != resolutionSchedule:
+    print("Resolution schedule should be a non increasing list of integer downsampling factors")
+    sys.exit(1)
+
+initialRef = ref
+for factor in sorted(set(resolution_factor(resolutionSchedule, k) for k in range(1, args.num_iterations + 1))):
+    if factor == 1:
+        continue
+
+    os.makedirs(level_folder(prefixBase, factor), exist_ok=True)
+    levelRef = level_reference(prefixBase, initialRef, filesExtension, factor)
+    if not os.path.exists(levelRef):
+        downsample_image(initialRef, levelRef, factor)
+
+    for index in range(1, args.num_images + 1):
+        levelImage = os.path.join(level_folder(prefixBase, factor), prefix + "_" + str(index) + filesExtension)
+        if not os.path.exists(levelImage):
+            downsample_image(os.path.join(prefixBase, prefix + "_" + str(index) + filesExtension), levelImage, factor)
+
+ref = level_reference(prefixBase, initialRef, filesExtension, resolution_factor(resolutionSchedule, 1))
 
 for k in range(1, args.num_iterations + 1):
     if os.path.exists('it_' + str(k) + '_done'):
-        ref = "averageDTI" + str(k) + ".nrrd"
+        ref = next_reference(resolutionSchedule, "averageDTI", k, args.num_iterations)
         firstImage = 1
         continue
 
+    if os.path.exists(CONVERGED_MARKER):
+        print("Atlas converged before iteration " + str(k) + ", final average: " + ref)
+        break
+
     print("*************Iteration " + str(k) + ", processing reference: " + ref)
 
-    for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag'):
+    for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag') + glob.glob("residualDir/" + prefix + '_*_failed'):
         os.remove(f)
 
-    numJobs = args.num_images - firstImage + 1
-    nCoresPhysical = int(args.num_cores / 2)
-
-    fileName = 'iterRun_' + str(k)
-    myfile = open(fileName,"w")
-    myfile.write("#!/bin/bash\n")
-    if args.num_cores <= 16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=07:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=07:59:00\n")
-    myfile.write("#OAR --array " + str(numJobs) + "\n")
-    myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
-    myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
-
-    myfile.write("cd " + os.getcwd() + "\n")
+    # Transformations from an earlier run are not valid initializations for a new atlas
+    if k == 1 and os.path.exists("transformStore"):
+        shutil.rmtree("transformStore")
 
     if k == 1 and args.ref_image == "":
-        numIt=0
-        myfile.write("let index=${OAR_ARRAY_INDEX}+1\n")
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $index -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+        numIt = 0
     else:
-        numIt=k
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+        numIt = k
+
+    factor = resolution_factor(resolutionSchedule, k)
+    levelPrefixBase = prefixBase
+    if factor > 1:
+        levelPrefixBase = level_folder(prefixBase, factor)
+
+    # Convergence is only checked at native resolution, the schedule being non increasing
+    mergeOptions = []
+    if factor == 1:
+        mergeOptions += convergenceOptions
+    nextRef = next_reference(resolutionSchedule, "averageDTI", k, args.num_iterations)
+    if nextRef != "averageDTI" + str(k) + ".nrrd":
+        mergeOptions += ["--next-ref", nextRef, "--next-ref-geometry",
+                         level_reference(prefixBase, initialRef, filesExtension, resolution_factor(resolutionSchedule, k + 1))]
+
+    if args.executor == "local":
+        registrationCommands = []
+        registrationLogs = []
+        for index in range(firstImage, args.num_images + 1):
+            command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py"),
+                       "-d", os.getcwd(), "-r", ref, "-B", levelPrefixBase, "-p", prefix, "-e", filesExtension,
+                       "-n", str(index), "-b", str(args.bch_order), "-c", str(args.num_cores)]
+            if args.rigid is True:
+                command += ["--rigid"]
+            if args.warm_start is True:
+                command += ["--warm-start"]
+
+            registrationCommands += [command]
+            registrationLogs += [os.path.join(os.getcwd(), "reg-" + str(k) + "." + str(index))]
+
+        returnCodes = run_jobs(registrationCommands, registrationLogs, int(localCores / args.num_cores))
+
+        failedImages = []
+        for index, returnCode in zip(range(firstImage, args.num_images + 1), returnCodes):
+            if returnCode != 0 or not os.path.exists(os.path.join("residualDir", prefix + "_" + str(index) + "_flag")):
+                failedImages += [str(index)]
+
+        if len(failedImages) > 0:
+            print("Registration failed for images " + " ".join(failedImages) + " at iteration " + str(k) + ", see reg-" + str(k) + ".*.error")
+            sys.exit(1)
+
+        command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/dti/animaMergeDTImages.py"),
+                   "-d", os.getcwd(), "-B", levelPrefixBase, "-p", prefix, "-i", str(numIt), "-n", str(args.num_images),
+                   "-r", ref, "-e", filesExtension, "-c", str(localCores)]
+        if not args.weights_file == "":
+            command += ["-w", args.weights_file]
+        command += mergeOptions
+
+        returnCode = run_job(command, os.path.join(os.getcwd(), "merge-" + str(k)))
+        if returnCode != 0 or not os.path.exists('it_' + str(k) + '_done'):
+            print("Merge failed at iteration " + str(k) + ", see merge-" + str(k) + ".error")
+            sys.exit(1)
+
+        if os.path.exists(CONVERGED_MARKER):
+            print("Atlas converged at iteration " + str(k) + ", final average: averageDTI" + str(k) + ".nrrd")
+            break
 
-    if args.rigid is True:
-        myfile.write(" --rigid\n")
+        # Same clean-up as the one performed by the merge step when the next iteration is already scheduled on OAR
+        if k < args.num_iterations:
+            shutil.rmtree("residualDir")
+            shutil.rmtree("tempDir")
+            os.makedirs('tempDir')
+            os.makedirs('residualDir')
     else:
+        numJobs = args.num_images - firstImage + 1
+        nCoresPhysical = int(args.num_cores / 2)
+
+        fileName = 'iterRun_' + str(k)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores <= 16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=07:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=07:59:00\n")
+        myfile.write("#OAR --array " + str(numJobs) + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
+
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write("if [ -e " + CONVERGED_MARKER + " ]; then exit 0; fi\n")
+
+        if k == 1 and args.ref_image == "":
+            myfile.write("let index=${OAR_ARRAY_INDEX}+1\n")
+            myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
+                         " -d " + os.getcwd() + " -r " + ref + " -B " + levelPrefixBase + " -p " + prefix + " -e " + filesExtension +
+                         " -n $index -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+        else:
+            myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
+                         " -d " + os.getcwd() + " -r " + ref + " -B " + levelPrefixBase + " -p " + prefix + " -e " + filesExtension +
+                         " -n $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+
+        if args.rigid is True:
+            myfile.write(" --rigid")
+        if args.warm_start is True:
+            myfile.write(" --warm-start")
         myfile.write("\n")
 
-    myfile.close()
-    os.chmod(fileName, stat.S_IRWXU)
-
-    oarRunCommand = ["oarsub"]
-    if previousMergeId == 0:
-        oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/iterRun_" + str(k)]
-    else:
-        oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/iterRun_" + str(k)]
-
-    jobsIds = []
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            jobsIds += [statsLine.split("=")[1]]
-
-    fileName = 'mergeRun_' + str(k)
-    myfile = open(fileName,"w")
-    myfile.write("#!/bin/bash\n")
-    if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=03:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=03:59:00\n")
-    myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.output\n")
-    myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.error\n")
-
-    myfile.write("cd " + os.getcwd() + "\n")
-    myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaMergeDTImages.py") +
-                 " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(numIt) +
-                 " -n " + str(args.num_images) + " -r " + ref + " -e " + filesExtension + " -c " + str(args.num_cores))
-
-    if not args.weights_file == "":
-        myfile.write(" -w " + args.weights_file + "\n")
-    else:
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
+
+        oarRunCommand = ["oarsub"]
+        if previousMergeId == 0:
+            oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/iterRun_" + str(k)]
+        else:
+            oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/iterRun_" + str(k)]
+
+        jobsIds = []
+        procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+        statLines = procStat.stdout.decode('utf-8').split('\n')
+        for statsLine in statLines:
+            if "OAR_JOB_ID" in statsLine:
+                jobsIds += [statsLine.split("=")[1]]
+
+        fileName = 'mergeRun_' + str(k)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores<=16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=03:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=03:59:00\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.error\n")
+
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write("if [ -e " + CONVERGED_MARKER + " ]; then exit 0; fi\n")
+        myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaMergeDTImages.py") +
+                     " -d " + os.getcwd() + " -B " + levelPrefixBase + " -p " + prefix + " -i " + str(numIt) +
+                     " -n " + str(args.num_images) + " -r " + ref + " -e " + filesExtension + " -c " + str(args.num_cores))
+
+        if not args.weights_file == "":
+            myfile.write(" -w " + args.weights_file)
+
+        if len(mergeOptions) > 0:
+            myfile.write(" " + " ".join(mergeOptions))
         myfile.write("\n")
 
-    myfile.close()
-    os.chmod(fileName, stat.S_IRWXU)
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub","-n","merge-" + str(k),"-S",os.getcwd() + "/mergeRun_" + str(k)]
+        oarRunCommand = ["oarsub","-n","merge-" + str(k),"-S",os.getcwd() + "/mergeRun_" + str(k)]
 
-    for jobId in jobsIds:
-        oarRunCommand += ["-a",jobId]
+        for jobId in jobsIds:
+            oarRunCommand += ["-a",jobId]
 
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            previousMergeId = statsLine.split("=")[1]
-            break
+        procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+        statLines = procStat.stdout.decode('utf-8').split('\n')
+        for statsLine in statLines:
+            if "OAR_JOB_ID" in statsLine:
+                previousMergeId = statsLine.split("=")[1]
+                break
 
-    ref = "averageDTI" + str(k) + ".nrrd"
+    ref = next_reference(resolutionSchedule, "averageDTI", k, args.num_iterations)
     firstImage = 1
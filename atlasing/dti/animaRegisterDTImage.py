@@ -21,6 +21,12 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaCompletionWait import register_failure_flag
+from animaDerivedMapCache import cached_map
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,18 +40,27 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-n', '--num-image', type=int, required=True, help='Image number')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Initialize registrations from the transformations of the previous iteration (kept in transformStore)")
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 basePrefBase = os.path.dirname(args.prefix_base)
 
+register_failure_flag(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"))
+
+# Transformations of the previous iteration, kept out of tempDir as it is wiped between iterations. One store per
+# images folder, so that iterations at different resolutions do not share transformations
+storePrefix = os.path.join(basePrefBase,"transformStore",os.path.basename(os.path.normpath(args.prefix_base)),
+                           args.prefix + "_" + str(args.num_image))
+warmStart = args.warm_start is True and os.path.exists(storePrefix + "_aff_tr.txt") and os.path.exists(storePrefix + "_bal_tr.nrrd")
+
 animaDTIScalarMaps = os.path.join(animaDir,"animaDTIScalarMaps")
 animaCreateImage = os.path.join(animaDir,"animaCreateImage")
 animaMaskImage = os.path.join(animaDir,"animaMaskImage")
 animaThrImage = os.path.join(animaDir,"animaThrImage")
 animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
 animaDenseTensorSVFBMRegistration = os.path.join(animaDir,"animaDenseTensorSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaLinearTransformArithmetic = os.path.join(animaDir,"animaLinearTransformArithmetic")
 animaLinearTransformToSVF = os.path.join(animaDir,"animaLinearTransformToSVF")
 animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
@@ -54,37 +69,41 @@ animaTensorApplyTransformSerie = os.path.join(animaDir,"animaTensorApplyTransfor
 
 filesExtension = args.files_extension
 
-# Extract DTI scalar map
-command = [animaDTIScalarMaps,
-           "-i", os.path.join(args.prefix_base, args.prefix + "_" + str(args.num_image) + filesExtension),
-           "-a", os.path.join(args.prefix_base, args.prefix + "_" + str(args.num_image) + "_ADC.nrrd")]
-call(command)
+# Extract DTI scalar maps: the subject ADC is computed once for all iterations, the reference one once per iteration
+# (tempDir being wiped between iterations) by the first registration needing it. Subject maps are kept in the working
+# folder (one folder per images folder, as the transformation store), never next to the input images
+subjectImage = os.path.join(args.prefix_base, args.prefix + "_" + str(args.num_image) + filesExtension)
+subjectADC = cached_map(os.path.join(basePrefBase, "derivedMaps", os.path.basename(os.path.normpath(args.prefix_base)),
+                                     args.prefix + "_" + str(args.num_image) + "_ADC.nrrd"), [subjectImage],
+                        lambda outputFile: call([animaDTIScalarMaps, "-i", subjectImage, "-a", outputFile]))
 
-command = [animaDTIScalarMaps, "-i", args.ref_image, "-a",
-           os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_ref_ADC.nrrd")]
-call(command)
+refADC = cached_map(os.path.join(basePrefBase, "tempDir", "ref_" + os.path.splitext(os.path.basename(args.ref_image))[0] + "_ADC.nrrd"),
+                    [args.ref_image], lambda outputFile: call([animaDTIScalarMaps, "-i", args.ref_image, "-a", outputFile]))
 
 # Rigid / affine registration
 command = [animaPyramidalBMRegistration,
-           "-r", os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_ref_ADC.nrrd"),
-           "-m", os.path.join(args.prefix_base, args.prefix + "_" + str(args.num_image) + "_ADC.nrrd"),
+           "-r", refADC, "-m", subjectADC,
            "-o", os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_aff_ADC.nrrd"),
            "-O", os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
            "--out-rigid", os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
-           "--ot", "2", "-p", "3", "-l", "0", "-I", "2", "-T", str(args.num_cores), "--sym-reg", "2", "-s", "0"]
+           "--ot", "2", "-l", "0", "-I", "2", "-T", str(args.num_cores), "--sym-reg", "2", "-s", "0"]
+if warmStart:
+    # The previous transformation is close to the solution: coarsest pyramid level is skipped
+    command += ["-i", storePrefix + "_aff_tr.txt", "-p", "2"]
+else:
+    command += ["-p", "3"]
 call(command)
 
 # Apply to DTI and prepare data crop for better registration
 
-command = [animaTransformSerieXmlGenerator,"-i",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-           "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.xml")]
-call(command)
+write_transform_serie_xml([os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt")],
+                          os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.xml"))
 
 command = [animaCreateImage,"-b","1","-v","1","-g",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
            "-o",os.path.join(basePrefBase,"tempDir","tmpFullMask_" + str(args.num_image) + ".nrrd")]
 call(command)
 
-command = [animaApplyTransformSerie,"-g",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_ref_ADC.nrrd"),
+command = [animaApplyTransformSerie,"-g",refADC,
            "-i",os.path.join(basePrefBase,"tempDir","tmpFullMask_" + str(args.num_image) + ".nrrd"),
            "-t",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.xml"),
            "-o",os.path.join(basePrefBase,"tempDir","tmpMask_" + str(args.num_image) + ".nrrd"),
@@ -96,8 +115,18 @@ command = [animaMaskImage, "-i", args.ref_image,
            "-o", os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_ref_c.nrrd")]
 call(command)
 
+# With a warm start, the tensor image is also resampled with the previous non linear transformation, so that only
+# the residual from it is estimated
+if warmStart:
+    write_transform_serie_xml([os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
+                               storePrefix + "_bal_tr.nrrd"],
+                              os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_warm_tr.xml"))
+    dtiTransform = os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_warm_tr.xml")
+else:
+    dtiTransform = os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.xml")
+
 command = [animaTensorApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
-           "-g",args.ref_image,"-t",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.xml"),
+           "-g",args.ref_image,"-t",dtiTransform,
            "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),"-p",str(args.num_cores)]
 call(command)
 
@@ -107,10 +136,27 @@ call(command)
 command = [animaDenseTensorSVFBMRegistration,"-r",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_ref_c.nrrd"),
            "-m",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
            "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal.nrrd"),
-           "-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
            "--tub","2","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","3","-s","0.001"]
+if warmStart:
+    command += ["-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"),"-p","2"]
+else:
+    command += ["-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")]
 call(command)
 
+if warmStart:
+    command = [animaDenseTransformArithmetic,"-i",storePrefix + "_bal_tr.nrrd",
+               "-c",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"),
+               "-b",str(args.bch_order),
+               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")]
+    call(command)
+
+    os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_res_tr.nrrd"))
+
+if args.warm_start is True:
+    os.makedirs(os.path.dirname(storePrefix), exist_ok=True)
+    shutil.copy(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"), storePrefix + "_aff_tr.txt")
+    shutil.copy(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"), storePrefix + "_bal_tr.nrrd")
+
 os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_ref_c.nrrd"))
 
 if args.rigid is True:
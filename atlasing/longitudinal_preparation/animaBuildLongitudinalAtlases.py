@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaBuildLongitudinalAtlases.py ..." has to be run
+
+import argparse
+import atexit
+import glob
+import hashlib
+import os
+import shutil
+import signal
+import sys
+import subprocess
+import time
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+if not os.path.exists(configFilePath):
+    print('Please create a configuration file for Anima python scripts. Refer to the README')
+    quit()
+
+configParser = ConfParser.RawConfigParser()
+configParser.read(configFilePath)
+
+animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaLocalExecutor import get_local_cores
+from animaTaskQueue import init_queue, run_queued_jobs, stop_workers
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Builds all sub-atlases prepared by animaComputeLongitudinalAtlasWeights.py at the same time on the local "
+                "machine: the weighted anatomical atlas builds of the atlas_* folders share one pool of workers sized by "
+                "a core (and memory) budget, so that registrations of some sub-atlases run while others merge. Options "
+                "not listed here are given to animaBuildAnatomicalAtlas.py.")
+parser.add_argument('-d', '--out-dir', type=str, required=True, help='Output folder of animaComputeLongitudinalAtlasWeights.py')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix of subjects given to animaComputeLongitudinalAtlasWeights.py')
+parser.add_argument('-r', '--template', type=str, default="",
+                    help='Global template shared by all sub-atlases: each subject is registered once onto it, the first '
+                         'iteration of every sub-atlas being its weighted average of these shared registrations (default: '
+                         'none, each sub-atlas starts from its own first image)')
+parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of cores of each registration or merge task (default: 8)')
+parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations in rigid unbiased (default: 2)')
+parser.add_argument('--rigid', action='store_true', help="Unbiased atlases up to a rigid transformation")
+parser.add_argument('--local-cores', type=int, default=0,
+                    help='Total number of cores shared by all sub-atlases (default: all available cores)')
+parser.add_argument('--memory-budget', type=float, default=0,
+                    help='Total memory (in GB) shared by all sub-atlases (default: 0, only cores are budgeted)')
+parser.add_argument('--task-memory', type=float, default=4,
+                    help='Memory (in GB) needed by one registration or merge task, used with --memory-budget (default: 4)')
+
+args, atlasOptions = parser.parse_known_args()
+
+
+def file_extension(file_name):
+    fileExtension = os.path.splitext(file_name)[1]
+    if fileExtension == '.gz':
+        fileExtension = os.path.splitext(os.path.splitext(file_name)[0])[1] + fileExtension
+
+    return fileExtension
+
+
+def stop_builds():
+    # Sub-atlas drivers would otherwise wait for tasks that stopped workers never run
+    for atlasDir, process, logFiles in builds:
+        if process.poll() is None:
+            process.terminate()
+
+
+# Subjects of each sub-atlas are in atlas_i/<prefix folder>, which only holds for a relative prefix
+if os.path.isabs(args.prefix):
+    print("The prefix of subjects has to be relative, as given to animaComputeLongitudinalAtlasWeights.py (e.g. data/S)")
+    sys.exit(1)
+
+outDir = os.path.abspath(args.out_dir)
+# Only atlas_<number> folders are sub-atlases, other entries (e.g. atlas_1.bak) are left aside
+atlasDirs = [folder for folder in glob.glob(os.path.join(outDir, "atlas_[0-9]*"))
+             if os.path.isdir(folder) and os.path.basename(folder)[len("atlas_"):].isdigit()]
+atlasDirs = sorted(atlasDirs, key=lambda folder: int(os.path.basename(folder)[len("atlas_"):]))
+atlasDirs = [atlasDir for atlasDir in atlasDirs if os.path.exists(os.path.join(atlasDir, "weights.txt"))]
+if len(atlasDirs) == 0:
+    print("No sub-atlas folder with a weights.txt file in " + outDir)
+    sys.exit(1)
+
+# One worker per task slot of the budget, each task running on -c cores
+numWorkers = max(1, int(get_local_cores(args.local_cores) / args.num_cores))
+if args.memory_budget > 0:
+    numWorkers = max(1, min(numWorkers, int(args.memory_budget / args.task_memory)))
+
+print("Building " + str(len(atlasDirs)) + " sub-atlases with " + str(numWorkers) + " workers of " + str(args.num_cores) + " cores")
+
+queueDir = os.path.join(outDir, "taskQueue")
+init_queue(queueDir)
+atexit.register(stop_workers, queueDir)
+# Exiting on SIGTERM runs the atexit handlers, so that workers are stopped when the driver is killed
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+# Workers never exit on their own: sub-atlases may spend some time in their drivers (e.g. reference selection)
+workerCommand = [sys.executable, os.path.join(animaScriptsDir,"atlasing/anatomical/animaAtlasPilotWorker.py"), "-q", queueDir,
+                 "--idle-timeout", "0"]
+for worker in range(1, numWorkers + 1):
+    with open(os.path.join(outDir, "pilot." + str(worker) + ".output"), "w") as outFile, \
+            open(os.path.join(outDir, "pilot." + str(worker) + ".error"), "w") as errFile:
+        subprocess.Popen(workerCommand, stdout=outFile, stderr=errFile)
+
+prefixName = os.path.basename(args.prefix)
+atlasSubjects = [open(os.path.join(atlasDir, "subjects.txt")).read().split() for atlasDir in atlasDirs]
+
+if args.template != "":
+    # Subjects of overlapping sub-atlases are registered once onto the template, in a folder laid out as an atlas
+    # working folder with one image per distinct subject
+    sharedDir = os.path.join(outDir, "sharedRegistration")
+
+    # Registrations are only reused if they were made onto the same template with the same options
+    registrationKey = hashlib.sha256()
+    with open(args.template, "rb") as templateFile:
+        registrationKey.update(templateFile.read())
+    registrationKey.update(repr([os.path.realpath(args.template), args.rigid, args.bch_order]).encode())
+    registrationKey = registrationKey.hexdigest()
+
+    registrationKeyFile = os.path.join(sharedDir, "registrationKey.txt")
+    cachedKey = None
+    if os.path.exists(registrationKeyFile):
+        with open(registrationKeyFile) as keyFile:
+            cachedKey = keyFile.read().strip()
+
+    if cachedKey != registrationKey and os.path.exists(sharedDir):
+        print("Template or registration options changed, registering all subjects again")
+        shutil.rmtree(sharedDir)
+
+    for folder in ["data", "tempDir", "residualDir"]:
+        os.makedirs(os.path.join(sharedDir, folder), exist_ok=True)
+
+    with open(registrationKeyFile, "w") as keyFile:
+        keyFile.write(registrationKey + "\n")
+
+    subjects = []
+    sharedIndices = {}
+    for sub in atlasSubjects:
+        for subject in sub:
+            if subject not in sharedIndices:
+                subjects += [subject]
+                sharedIndices[subject] = len(subjects)
+
+    registrationCommands = []
+    registrationLogs = []
+    for index in range(1, len(subjects) + 1):
+        fileExtension = file_extension(subjects[index - 1])
+        sharedImage = os.path.join(sharedDir, "data", prefixName + "_" + str(index) + fileExtension)
+        if os.path.lexists(sharedImage) and os.path.realpath(sharedImage) == os.path.realpath(subjects[index - 1]) and \
+                os.path.exists(os.path.join(sharedDir, "tempDir", prefixName + "_" + str(index) + "_nonlinear_tr.nrrd")):
+            continue
+
+        for f in glob.glob(os.path.join(sharedDir, "*", prefixName + "_" + str(index) + "_*")):
+            os.remove(f)
+        if os.path.lexists(sharedImage):
+            os.remove(sharedImage)
+        os.symlink(os.path.abspath(subjects[index - 1]), sharedImage)
+
+        command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/anatomical/animaAnatomicalRegisterImage.py"),
+                   "-d", sharedDir, "-r", os.path.abspath(args.template), "-B", os.path.join(sharedDir, "data"),
+                   "-p", prefixName, "-e", fileExtension, "-n", str(index), "-b", str(args.bch_order), "-c", str(args.num_cores)]
+        if args.rigid is True:
+            command += ["--rigid"]
+
+        registrationCommands += [command]
+        registrationLogs += [os.path.join(sharedDir, "reg." + str(index))]
+
+    print("Registering " + str(len(registrationCommands)) + " of " + str(len(subjects)) + " distinct subjects onto the template")
+    returnCodes = run_queued_jobs(queueDir, registrationCommands, registrationLogs,
+                                  ["shared-" + os.path.basename(log) for log in registrationLogs])
+    missing = [subject for subject in subjects if not os.path.exists(
+        os.path.join(sharedDir, "tempDir", prefixName + "_" + str(sharedIndices[subject]) + "_nonlinear_tr.nrrd"))]
+    if len(missing) > 0 or (len(returnCodes) > 0 and max(returnCodes) != 0):
+        print("Registration onto the template failed, see " + os.path.join(sharedDir, "reg.*.error"))
+        sys.exit(1)
+
+    # Each sub-atlas reuses the shared transformations of its subjects at its first iteration
+    for atlasDir, sub in zip(atlasDirs, atlasSubjects):
+        reuseDir = os.path.join(atlasDir, "sharedTransforms")
+        os.makedirs(reuseDir, exist_ok=True)
+        for index in range(1, len(sub) + 1):
+            sharedIndex = sharedIndices[sub[index - 1]]
+            for suffix in ["_linear_tr.txt", "_nonlinear_tr.nrrd"]:
+                link = os.path.join(reuseDir, prefixName + "_" + str(index) + suffix)
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(os.path.join(sharedDir, "tempDir", prefixName + "_" + str(sharedIndex) + suffix), link)
+
+# Atlas drivers mostly wait for their tasks: they all run at once, their tasks being packed on the shared workers
+builds = []
+atexit.register(stop_builds)
+for atlasDir, sub in zip(atlasDirs, atlasSubjects):
+    command = [sys.executable, os.path.join(animaScriptsDir,"atlasing/anatomical/animaBuildAnatomicalAtlas.py"),
+               "-p", os.path.join(atlasDir, args.prefix), "-n", str(len(sub)), "-c", str(args.num_cores),
+               "-b", str(args.bch_order), "-w", os.path.join(atlasDir, "weights.txt"),
+               "--executor", "pilot", "--pilot-queue", queueDir]
+    if args.rigid is True:
+        command += ["--rigid"]
+    if args.template != "":
+        command += ["-r", os.path.abspath(args.template), "--first-reuse-dir", os.path.join(atlasDir, "sharedTransforms")]
+    command += atlasOptions
+
+    outFile = open(os.path.join(atlasDir, "build.output"), "w")
+    errFile = open(os.path.join(atlasDir, "build.error"), "w")
+    builds += [(atlasDir, subprocess.Popen(command, cwd=atlasDir, stdout=outFile, stderr=errFile), [outFile, errFile])]
+
+failedAtlases = []
+while len(builds) > 0:
+    for build in list(builds):
+        atlasDir, process, logFiles = build
+        returnCode = process.poll()
+        if returnCode is None:
+            continue
+
+        builds.remove(build)
+        for logFile in logFiles:
+            logFile.close()
+
+        if returnCode == 0:
+            print(os.path.basename(atlasDir) + " done")
+        else:
+            print(os.path.basename(atlasDir) + " failed, see " + os.path.join(atlasDir, "build.error"))
+            failedAtlases += [os.path.basename(atlasDir)]
+
+    if len(builds) > 0:
+        time.sleep(10)
+
+if len(failedAtlases) > 0:
+    print("Failed sub-atlases: " + " ".join(failedAtlases))
+    sys.exit(1)
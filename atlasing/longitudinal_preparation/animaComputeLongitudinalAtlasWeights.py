@@ -2,12 +2,14 @@
 # Warning: works only on unix-like systems, not windows where "python animaComputeLongitudinalAtlasWeights.py ..." has to be run
 
 import argparse
+import hashlib
 import os
 import shutil
 import numpy as np
 from scipy import signal
 import pandas as pd 
-from animaPolynomialKernel import polynomial_kernel
+from animaFileMaterialization import MATERIALIZATION_MODES, materialize_file
+from animaPolynomialKernel import age_moment_index, kernel_bias, polynomial_kernel
 
 # Argument parsing
 parser = argparse.ArgumentParser(description="Compute data weights for building an atlas at the specified age")
@@ -24,6 +26,13 @@ parser.add_argument('-u', '--nb-iter', type=int, default=30, help='number of ite
 parser.add_argument('-v', '--alpha-sampleSize', type=int, default=500, help='size of alpha sampling (default: 500)')
 parser.add_argument('-b', '--tol-bias', type=float, default=0.005, help='maximum bias tolerance (default: 0.005)')
 parser.add_argument('-s', '--init-window', type=float, default=3, help='initial size of age window (default: 3)')
+parser.add_argument('--interpolate', action='store_true',
+                    help='build sub-atlases at the exact desired ages, windows being interpolated from the sampled model '
+                         '(falls back to the closest sample time when the interpolated window is too biased)')
+parser.add_argument('-m', '--materialization', type=str, default='auto', choices=MATERIALIZATION_MODES,
+                    help='how subject images are put in sub-atlas folders: hard links, then reflinks, copies being made '
+                         'only when linking is not possible (auto), or one of hardlink, reflink, symlink, copy (default: auto)')
+parser.add_argument('--force', action='store_true', help='re-run the window optimization even if a cached model matches')
 
 args = parser.parse_args()
 
@@ -31,7 +40,7 @@ ages = np.loadtxt(fname=args.age_file)
 images = np.genfromtxt(args.image_file, dtype='str')
 outDir = args.out_dir
 N = args.nb_images
-wantedAge = np.loadtxt(fname=args.age_atlas)
+wantedAge = np.loadtxt(fname=args.age_atlas, ndmin=1)
 prefix = os.path.split(args.prefix)
 
 sampleSize = args.t_sampleSize
@@ -44,53 +53,94 @@ t = np.linspace(min(ages), max(ages), sampleSize)
 alpha = np.zeros(sampleSize)
 n = np.zeros(sampleSize)
 
-print("optimizing kernel window over temporal bias...")
-for it in range(1, itmax+1):
-    print(str(it)+"/"+str(itmax))
-    
-    bias = np.inf*np.ones(len(t))
-    for i in range(0, len(t)):
-        rangeAlpha = np.linspace(np.ceil(10000*(t[i]-3*s[i]/5))/10000, np.floor(10000*(t[i]-2*s[i]/5))/10000, alphaSampleSize)
-    
-        for alpha0 in rangeAlpha:
-            _, _, bias0, n0 = polynomial_kernel(ages, t[i], s[i], alpha0)
-            if bias0 < bias[i]:
-                alpha[i] = alpha0
-                bias[i] = bias0
-                n[i] = n0
-        
-        if it < itmax:
-            st=0.5*0.8**(it-1)        
-            if n[i] < N:
-                s[i] = s[i]+st
-            elif n[i] > N:
-                s[i] = s[i]-st
-            
-    if it == itmax-1:
-        s = signal.savgol_filter(s, int(2*np.floor(sampleSize/20)+1), 3)
-            
-modelInfo = {'sampleTime': t, 'windowSize': s, 'windowStart': alpha, 'windowFrequency': n, 'temporalBias': bias}
-df = pd.DataFrame(data=modelInfo)
-
 if not os.path.exists(outDir):
     os.makedirs(outDir)
 
-df.to_csv(os.path.join(outDir, "modelInfo.csv"))
+# The model only depends on the ages and on the optimization parameters: a matching cached model is reused, so that
+# sub-atlases at other ages do not require a new optimization
+modelKey = hashlib.sha256()
+with open(args.age_file, "rb") as ageFile:
+    modelKey.update(ageFile.read())
+modelKey.update(repr([N, sampleSize, itmax, alphaSampleSize, args.init_window]).encode())
+modelKey = modelKey.hexdigest()
+
+modelFile = os.path.join(outDir, "modelInfo.csv")
+modelKeyFile = os.path.join(outDir, "modelKey.txt")
+cachedKey = None
+if os.path.exists(modelFile) and os.path.exists(modelKeyFile):
+    with open(modelKeyFile) as keyFile:
+        cachedKey = keyFile.read().strip()
+
+if cachedKey == modelKey and not args.force:
+    print("reusing cached kernel window model...")
+    df = pd.read_csv(modelFile, index_col=0)
+    t = df['sampleTime'].values
+    s = df['windowSize'].values
+    alpha = df['windowStart'].values
+    n = df['windowFrequency'].values
+    bias = df['temporalBias'].values
+else:
+    print("optimizing kernel window over temporal bias...")
+    # Window sums of the kernel come from prefix moments of the sorted ages: the alpha sweeps of all sample times are
+    # evaluated at once, each evaluation costing O(log n)
+    ageIndex = age_moment_index(ages)
+    for it in range(1, itmax+1):
+        print(str(it)+"/"+str(itmax))
+
+        bias = np.inf*np.ones(len(t))
+        rangeAlpha = np.linspace(np.ceil(10000*(t-3*s/5))/10000, np.floor(10000*(t-2*s/5))/10000, alphaSampleSize, axis=-1)
+        bias0, n0 = kernel_bias(ageIndex, t[:, np.newaxis], s[:, np.newaxis], rangeAlpha)
+
+        # First alpha of lowest bias, sample times without any valid alpha keeping their previous window
+        bias0[np.isnan(bias0)] = np.inf
+        best = bias0.argmin(axis=-1)
+        found = np.where(bias0[np.arange(len(t)), best] < np.inf)[0]
+        alpha[found] = rangeAlpha[found, best[found]]
+        bias[found] = bias0[found, best[found]]
+        n[found] = n0[found, best[found]]
+
+        if it < itmax:
+            st=0.5*0.8**(it-1)
+            s = s + st*(n < N) - st*(n > N)
+
+        if it == itmax-1:
+            s = signal.savgol_filter(s, int(2*np.floor(sampleSize/20)+1), 3)
+
+    modelInfo = {'sampleTime': t, 'windowSize': s, 'windowStart': alpha, 'windowFrequency': n, 'temporalBias': bias}
+    df = pd.DataFrame(data=modelInfo)
+    df.to_csv(modelFile)
+    with open(modelKeyFile, "w") as keyFile:
+        keyFile.write(modelKey + "\n")
  
 print("choosing ages and subjects for each sub-atlas...")      
 okAge = t[bias < tolBias]
 atlasAge = np.zeros(len(wantedAge))
+atlasWindowSize = np.zeros(len(wantedAge))
+atlasWindowStart = np.zeros(len(wantedAge))
 
 for i in range(0, len(wantedAge)):
     indAge = abs(wantedAge[i]-okAge).argmin()
     atlasAge[i] = okAge[indAge]
+    indt = np.where(t == atlasAge[i])[0][0]
+    atlasWindowSize[i] = s[indt]
+    atlasWindowStart[i] = alpha[indt]
+
+    if args.interpolate and min(okAge) <= wantedAge[i] <= max(okAge):
+        # Window of the exact age, interpolated between the sample times around it
+        size = np.interp(wantedAge[i], t, s)
+        start = np.interp(wantedAge[i], t, alpha)
+        _, _, ageBias, _ = polynomial_kernel(ages, wantedAge[i], size, start)
+        if ageBias < tolBias:
+            atlasAge[i] = wantedAge[i]
+            atlasWindowSize[i] = size
+            atlasWindowStart[i] = start
 
 np.savetxt(os.path.join(outDir, "atlasAge.txt"), atlasAge)
 
-print("mkdirs and cp files...")
+print("mkdirs and materializing files...")
 for i in range(0, len(atlasAge)): 
-    indt = np.where(t == atlasAge[i])
-    w, ind, _, _ = polynomial_kernel(ages, t[indt], s[indt], alpha[indt])
+    w, ind, _, _ = polynomial_kernel(ages, atlasAge[i], atlasWindowSize[i], atlasWindowStart[i])
+    w = w[ind]
     sub=images[ind]
 
     if os.path.exists(os.path.join(outDir, "atlas_"+str(i+1))):
@@ -98,13 +148,20 @@ for i in range(0, len(atlasAge)):
 
     os.makedirs(os.path.join(outDir, "atlas_"+str(i+1)))
     os.makedirs(os.path.join(outDir, "atlas_"+str(i+1), prefix[0]))
+    manifest = [None] * len(sub)
+    methods = [None] * len(sub)
     for j in range(0, len(sub)):
         fileExtension = os.path.splitext(sub[j])[1]
         if fileExtension == '.gz':
             fileExtension = os.path.splitext(os.path.splitext(sub[j])[0])[1] + fileExtension
 
         dest = os.path.join(outDir, "atlas_"+str(i+1), prefix[0], prefix[1]+"_"+str(j+1)+fileExtension)
-        shutil.copyfile(sub[j], str(dest))
-        
+        methods[j] = materialize_file(sub[j], str(dest), args.materialization)
+        manifest[j] = os.path.join(prefix[0], prefix[1]+"_"+str(j+1)+fileExtension)
+
+    manifestInfo = {'file': manifest, 'source': sub, 'method': methods}
+    pd.DataFrame(data=manifestInfo).to_csv(os.path.join(outDir, "atlas_"+str(i+1), "manifest.csv"), index=False)
+    print("atlas_" + str(i+1) + ": " + ", ".join(str(methods.count(method)) + " " + method for method in sorted(set(methods))))
+
     np.savetxt(os.path.join(outDir, "atlas_"+str(i+1),"weights.txt"),w)
     np.savetxt(os.path.join(outDir, "atlas_"+str(i+1),"subjects.txt"),sub, fmt="%s")
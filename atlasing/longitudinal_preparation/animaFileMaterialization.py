@@ -0,0 +1,58 @@
+import errno
+import fcntl
+import os
+import shutil
+
+# Subjects belong to many overlapping sub-atlases: instead of copying their images in every atlas folder, files are
+# materialized as hard links or reflinks (copy on write clones) when the filesystem supports them, a plain copy being
+# only made when neither is possible (e.g. across devices). Symbolic links may be requested instead, the atlas folders
+# then depending on the original images.
+
+# Linux ioctl cloning a whole file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+MATERIALIZATION_MODES = ["auto", "hardlink", "reflink", "symlink", "copy"]
+
+
+def reflink_file(source, dest):
+    try:
+        with open(source, "rb") as sourceFile, open(dest, "wb") as destFile:
+            fcntl.ioctl(destFile.fileno(), FICLONE, sourceFile.fileno())
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+
+    shutil.copystat(source, dest)
+
+
+def materialize_file(source, dest, mode="auto"):
+    # Makes dest available with the contents of source, returns the method used (hardlink, reflink, symlink or copy)
+    if mode not in MATERIALIZATION_MODES:
+        raise ValueError("Unknown materialization mode " + mode)
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if mode == "symlink":
+        os.symlink(os.path.abspath(source), dest)
+        return "symlink"
+
+    if mode in ["auto", "hardlink"]:
+        try:
+            os.link(source, dest)
+            return "hardlink"
+        except OSError as error:
+            if mode == "hardlink" and error.errno != errno.EXDEV:
+                raise
+
+    if mode in ["auto", "hardlink", "reflink"]:
+        try:
+            reflink_file(source, dest)
+            return "reflink"
+        except OSError as error:
+            if mode == "reflink" and error.errno != errno.EXDEV:
+                raise
+
+    shutil.copyfile(source, dest)
+    return "copy"
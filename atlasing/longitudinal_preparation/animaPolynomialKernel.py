@@ -1,27 +1,100 @@
+from math import comb
+
 import numpy as np
 
 
-def polynomial_kernel(ages, T, s, alpha):
-    ind = (ages > alpha) * (ages < alpha + s)
-    ages = ages[ind]
-    n = len(ages)
-    
+def kernel_coefficients(T, s, alpha):
+    # Coefficients of the cubic factor of the kernel, T, s and alpha being broadcast together
+    T, s, alpha = np.broadcast_arrays(np.asarray(T, dtype=float), np.asarray(s, dtype=float), np.asarray(alpha, dtype=float))
+
     a = (60*(2*alpha-2*T+s))/((s**5)*(s**2+5*s*(alpha-T)+5*(alpha**2-2*T*alpha+T**2)))
-    
+
     eps = np.finfo(float).eps
     lowAlphaBound = T - s / 2 - 10 * eps
     upperAlphaBound = T - s / 2 + 10 * eps
-    if alpha > lowAlphaBound and alpha < upperAlphaBound:
-        b = 30/s**5
-    else:
-        b = a*(5*T**2+2*T*alpha+T*s-7*alpha**2-7*alpha*s-2*s**2) / (4*alpha-4*T+2*s)
+    centered = (alpha > lowAlphaBound) * (alpha < upperAlphaBound)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = np.where(centered, 30/s**5, a*(5*T**2+2*T*alpha+T*s-7*alpha**2-7*alpha*s-2*s**2) / (4*alpha-4*T+2*s))
 
     c = a*(-3 * alpha ** 2 - 3 * alpha * s - s ** 2) + b * (-2 * alpha - s)
     d = -a*alpha**3-b*alpha**2-c*alpha
-    
-    w = (ages - alpha) * (ages - (alpha + s)) * (a*ages**3 + b*ages**2 + c*ages + d)
-    w = w / sum(w)
-    
-    bias=abs(sum(w*ages)-T)
+
+    return a, b, c, d
+
+
+def polynomial_kernel(ages, T, s, alpha):
+    # T, s and alpha may be arrays (e.g. a sweep of alpha for many sample times), broadcast together to a shape S.
+    # Weights w and window indicators ind have shape S + ages.shape (weights being 0 outside of the window), bias and
+    # number of images n have shape S
+    a, b, c, d = kernel_coefficients(T, s, alpha)
+    a, b, c, d = [coefficient[..., np.newaxis] for coefficient in [a, b, c, d]]
+    T, s, alpha = [np.asarray(value, dtype=float)[..., np.newaxis] for value in np.broadcast_arrays(T, s, alpha)]
+
+    ind = (ages > alpha) * (ages < alpha + s)
+    n = ind.sum(axis=-1)
+
+    w = ind * (ages - alpha) * (ages - (alpha + s)) * (a*ages**3 + b*ages**2 + c*ages + d)
+    w = np.divide(w, w.sum(axis=-1, keepdims=True), out=np.zeros(w.shape), where=n[..., np.newaxis] > 0)
+
+    bias = abs((w*ages).sum(axis=-1) - T[..., 0])
 
     return w, ind, bias, n
+
+
+def age_moment_index(ages):
+    # Sorted ages and prefix sums of their powers 0 to 6 (centered on the mean age): sums of the kernel (a degree 5
+    # polynomial) and of its first moment over any window are then differences of two prefix sums. Prefix sums are
+    # accumulated with compensated summation and kept as (sum, error) pairs, so that differences of close prefix sums
+    # remain accurate on large cohorts
+    sortedAges = np.sort(np.asarray(ages, dtype=float))
+    center = sortedAges.mean()
+    powers = (sortedAges - center)[:, np.newaxis] ** np.arange(7)[np.newaxis, :]
+
+    sums = np.zeros((len(sortedAges) + 1, 7))
+    errors = np.zeros((len(sortedAges) + 1, 7))
+    for i in range(len(sortedAges)):
+        # Two-sum of the previous prefix sum and of the next powers
+        sums[i + 1] = sums[i] + powers[i]
+        virtualPowers = sums[i + 1] - sums[i]
+        errors[i + 1] = errors[i] + ((sums[i] - (sums[i + 1] - virtualPowers)) + (powers[i] - virtualPowers))
+
+    return {"ages": sortedAges, "center": center, "sums": sums.T, "errors": errors.T}
+
+
+def window_moments(index, start, end):
+    # Sums of the powers 0 to 6 of the centered ages of sorted positions start to end - 1 (arrays of any shape S),
+    # returned with shape (7,) + S
+    return (index["sums"][:, end] - index["sums"][:, start]) + (index["errors"][:, end] - index["errors"][:, start])
+
+
+def kernel_bias(index, T, s, alpha):
+    # Same bias and number of images as polynomial_kernel, in O(log n) per evaluation from an age_moment_index
+    T, s, alpha = [np.asarray(value, dtype=float) for value in np.broadcast_arrays(T, s, alpha)]
+
+    start = np.searchsorted(index["ages"], alpha, side='right')
+    end = np.maximum(np.searchsorted(index["ages"], alpha + s, side='left'), start)
+    n = end - start
+
+    # The cubic factor of the kernel vanishes at alpha: with z the age relative to the middle of the window and
+    # h = s/2, the kernel is (z^2 - h^2)^2 (a z + g), its coefficients only depending on e = alpha - T
+    h = s / 2
+    e = alpha - T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (60*(2*e+s))/((s**5)*(s**2+5*s*e+5*e**2))
+        g = a*h + (30*e*(5*e+3*s))/((s**5)*(s**2+5*s*e+5*e**2))
+
+    # Window moments are moved to the middle of the window
+    shift = alpha + h - index["center"]
+    globalMoments = window_moments(index, start, end)
+    moments = np.zeros(globalMoments.shape)
+    for m in range(7):
+        for k in range(m + 1):
+            moments[m] += comb(m, k) * (-shift) ** (m - k) * globalMoments[k]
+
+    total = g*(moments[4] - 2*h**2*moments[2] + h**4*moments[0]) + a*(moments[5] - 2*h**2*moments[3] + h**4*moments[1])
+    firstMoment = g*(moments[5] - 2*h**2*moments[3] + h**4*moments[1]) + a*(moments[6] - 2*h**2*moments[4] + h**4*moments[2])
+
+    meanAge = alpha + h + np.divide(firstMoment, total, out=np.zeros(s.shape), where=n > 0)
+    bias = np.where(n > 0, abs(meanAge - T), abs(T))
+
+    return bias, n
@@ -25,9 +25,13 @@ configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
 animaExtraDataDir = configParser.get("anima-scripts", 'extra-data-root')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
 animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaConvertImage = os.path.join(animaDir, "animaConvertImage")
 animaMaskImage = os.path.join(animaDir, "animaMaskImage")
@@ -117,9 +121,7 @@ if args.large_fov is True:
                "--ot", "2"] + pyramidOptions
     call(command)
 
-    command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_lfov_aff_tr.txt",
-               "-o", brainImagePrefix + "_lfov_aff_tr.xml"]
-    call(command)
+    write_transform_serie_xml([brainImagePrefix + "_lfov_aff_tr.txt"], brainImagePrefix + "_lfov_aff_tr.xml")
 
     command = [animaApplyTransformSerie, "-i", atlasLargeFOVHeadMask, "-t", brainImagePrefix + "_lfov_aff_tr.xml",
                "-o", brainImagePrefix + "_lfov_cropMask.nrrd", "-g", brainImage, "-n", "nearest"]
@@ -145,9 +147,7 @@ call(command)
 command = [animaCreateImage, "-g", atlasImage, "-b", "1", "-o", brainImagePrefix + "_baseCropMask.nrrd"]
 call(command)
 
-command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt",
-           "-o", brainImagePrefix + "_aff_tr.xml"]
-call(command)
+write_transform_serie_xml([brainImagePrefix + "_aff_tr.txt"], brainImagePrefix + "_aff_tr.xml")
 
 command = [animaApplyTransformSerie, "-i", brainImagePrefix + "_baseCropMask.nrrd",
            "-t", brainImagePrefix + "_aff_tr.xml", "-g", brainImage, "-o",
@@ -162,9 +162,9 @@ command = [animaDenseSVFBMRegistration, "-r", brainImagePrefix + "_c.nrrd", "-m"
            "-o", brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--tub", "2"] + pyramidOptions
 call(command)
 
-command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt", "-i",
-           brainImagePrefix + "_nl_tr.nrrd", "-o", brainImagePrefix + "_nl_tr.xml"]
-call(command)
+write_transform_serie_xml([brainImagePrefix + "_aff_tr.txt",
+                           brainImagePrefix + "_nl_tr.nrrd"],
+                          brainImagePrefix + "_nl_tr.xml")
 
 command = [animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
            brainImagePrefix + "_rough_brainMask.nrrd", "-n", "nearest"]
@@ -195,9 +195,9 @@ if args.second_step is True:
                brainImagePrefix + "_masked_nl.nrrd", "-O", brainImagePrefix + "_masked_nl_tr.nrrd", "--tub", "2"] + pyramidOptions
     call(command)
 
-    command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_masked_aff_tr.txt", "-i",
-               brainImagePrefix + "_masked_nl_tr.nrrd", "-o", brainImagePrefix + "_masked_nl_tr.xml"]
-    call(command)
+    write_transform_serie_xml([brainImagePrefix + "_masked_aff_tr.txt",
+                               brainImagePrefix + "_masked_nl_tr.nrrd"],
+                              brainImagePrefix + "_masked_nl_tr.xml")
 
     command = [animaApplyTransformSerie, "-i", iccImageFromMasked, "-t", brainImagePrefix + "_masked_nl_tr.xml",
                "-g", brainImage, "-o", brainMask, "-n", "nearest"]
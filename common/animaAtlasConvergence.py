@@ -0,0 +1,73 @@
+import math
+import os
+
+import numpy as np
+
+from animaImageIO import read_image
+
+# Convergence measures of iterative atlas construction. They are computed by the merge step at the end of each
+# iteration and appended to a log file. Once they fall below the requested thresholds, a marker file tells the jobs of
+# the remaining iterations (and the driver) that no further iteration is needed.
+
+CONVERGENCE_LOG = "convergence.txt"
+CONVERGED_MARKER = "atlas_converged"
+
+
+def displacement_rms(field_file, slab_size=16):
+    # RMS norm (in mm) of a displacement or velocity field, vector components being along the last axis
+    field, _ = read_image(field_file)
+    sumSquares = 0.0
+    for start in range(0, field.shape[0], slab_size):
+        slab = np.asarray(field[start:start + slab_size], dtype=np.float64)
+        sumSquares += np.sum(slab * slab)
+
+    return math.sqrt(sumSquares / (field.size / field.shape[-1]))
+
+
+def relative_change(current_file, previous_file, mask_file="", slab_size=16):
+    # Norm of the difference between two images, relative to the norm of the previous one, optionally within a mask.
+    # Not defined (NaN) when the images are not on the same grid
+    current, _ = read_image(current_file)
+    previous, _ = read_image(previous_file)
+    if current.shape != previous.shape:
+        return float("nan")
+
+    mask = None
+    if mask_file != "":
+        mask, _ = read_image(mask_file)
+        if mask.shape != current.shape[:mask.ndim]:
+            return float("nan")
+
+    sumSquaresDiff = 0.0
+    sumSquaresPrevious = 0.0
+    for start in range(0, current.shape[0], slab_size):
+        previousSlab = np.asarray(previous[start:start + slab_size], dtype=np.float64)
+        diffSlab = np.asarray(current[start:start + slab_size], dtype=np.float64) - previousSlab
+        if mask is not None:
+            maskSlab = np.asarray(mask[start:start + slab_size]) != 0
+            maskSlab = maskSlab.reshape(maskSlab.shape + (1,) * (current.ndim - mask.ndim))
+            previousSlab = previousSlab * maskSlab
+            diffSlab = diffSlab * maskSlab
+        sumSquaresDiff += np.sum(diffSlab * diffSlab)
+        sumSquaresPrevious += np.sum(previousSlab * previousSlab)
+
+    if sumSquaresPrevious == 0:
+        return float("nan")
+
+    return math.sqrt(sumSquaresDiff / sumSquaresPrevious)
+
+
+def log_convergence(iteration, displacement, intensity_change, log_file=CONVERGENCE_LOG):
+    newLog = not os.path.exists(log_file)
+    with open(log_file, "a") as logFile:
+        if newLog:
+            logFile.write("# iteration displacement_rms_mm relative_intensity_change\n")
+        logFile.write(str(iteration) + " " + str(displacement) + " " + str(intensity_change) + "\n")
+
+
+def has_converged(displacement, intensity_change, threshold, displacement_threshold):
+    # A threshold of 0 disables early stopping. Both measures have to be below their thresholds
+    if threshold <= 0 or math.isnan(intensity_change):
+        return False
+
+    return intensity_change < threshold and displacement < displacement_threshold
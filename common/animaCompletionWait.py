@@ -0,0 +1,140 @@
+import atexit
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import signal
+import sys
+import time
+
+# inotify events signaling that a flag file appeared in the watched folder
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def failure_flag_path(flag_file):
+    return flag_file[:-len("_flag")] + "_failed"
+
+
+def register_failure_flag(flag_file):
+    # Leaves a failure marker next to the completion flag if the calling script exits (or is killed by the scheduler)
+    # without having produced it, so that waiting merges stop right away. The registered function is returned, for
+    # callers that exit on purpose without producing the flag (atexit.unregister)
+    if os.path.exists(failure_flag_path(flag_file)):
+        os.remove(failure_flag_path(flag_file))
+
+    def write_failure_flag():
+        if not os.path.exists(flag_file):
+            open(failure_flag_path(flag_file), 'a').close()
+
+    atexit.register(write_failure_flag)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    return write_failure_flag
+
+
+def open_inotify(folder):
+    # Returns an inotify file descriptor watching folder, or -1 if inotify is not available
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return -1
+
+    if fd < 0:
+        return -1
+
+    if libc.inotify_add_watch(fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return -1
+
+    return fd
+
+
+def wait_for_events(fd, wait_time):
+    # Returns True if some event was received before wait_time
+    if fd < 0:
+        time.sleep(wait_time)
+        return False
+
+    readyFds, _, _ = select.select([fd], [], [], wait_time)
+    if len(readyFds) == 0:
+        return False
+
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    return True
+
+
+def wait_for_flag(flag_file, timeout=0, min_delay=1, max_delay=60):
+    # Waits until flag_file is present, same waiting scheme as wait_for_flags. Raises RuntimeError when its failure
+    # marker is found or after timeout seconds (no timeout if 0)
+    fd = open_inotify(os.path.dirname(os.path.abspath(flag_file)))
+    startTime = time.time()
+    delay = min_delay
+
+    try:
+        while not os.path.exists(flag_file):
+            if os.path.exists(failure_flag_path(flag_file)):
+                raise RuntimeError("Found failure marker " + failure_flag_path(flag_file))
+
+            waitTime = delay
+            if timeout > 0:
+                remainingTime = timeout - (time.time() - startTime)
+                if remainingTime <= 0:
+                    raise RuntimeError("Timed out after " + str(timeout) + " s waiting for " + flag_file)
+                waitTime = min(waitTime, remainingTime)
+
+            if wait_for_events(fd, waitTime):
+                delay = min_delay
+            else:
+                delay = min(max_delay, delay * 1.5)
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
+
+def wait_for_flags(folder, prefix, num_expected, timeout=0, min_delay=1, max_delay=60):
+    # Waits until num_expected "prefix_*_flag" files are present in folder.
+    # inotify wakes us up as soon as a flag is written locally, while the adaptive polling delay covers shared file
+    # systems on which writes from other nodes are not notified. Raises RuntimeError when a failure marker is found or
+    # after timeout seconds (no timeout if 0)
+    fd = open_inotify(folder)
+    startTime = time.time()
+    delay = min_delay
+    previousNumData = -1
+
+    try:
+        while True:
+            failedFlags = sorted(glob.glob(os.path.join(folder, prefix + "_*_failed")))
+            if len(failedFlags) > 0:
+                raise RuntimeError("Registration failed, found failure markers: " + " ".join(failedFlags))
+
+            numData = len(glob.glob(os.path.join(folder, prefix + "_*_flag")))
+            if numData >= num_expected:
+                return
+
+            if numData != previousNumData:
+                print("Missing data " + str(numData) + " " + str(num_expected))
+                previousNumData = numData
+
+            waitTime = delay
+            if timeout > 0:
+                remainingTime = timeout - (time.time() - startTime)
+                if remainingTime <= 0:
+                    raise RuntimeError("Timed out after " + str(timeout) + " s with " + str(numData) + " out of " +
+                                       str(num_expected) + " registrations done")
+                waitTime = min(waitTime, remainingTime)
+
+            if wait_for_events(fd, waitTime):
+                delay = min_delay
+            else:
+                delay = min(max_delay, delay * 1.5)
+    finally:
+        if fd >= 0:
+            os.close(fd)
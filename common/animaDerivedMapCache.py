@@ -0,0 +1,44 @@
+import fcntl
+import os
+
+# Maps derived from shared inputs (e.g. the ADC of the reference of an atlas iteration), computed once by the first
+# task needing them and reused by all others. Computation is protected by a lock file next to the map, and the map is
+# renamed in place once complete, so that a task never reads a partially written map.
+
+
+def is_up_to_date(output_file, input_files):
+    if not os.path.exists(output_file):
+        return False
+
+    outputTime = os.path.getmtime(output_file)
+    for inputFile in input_files:
+        if os.path.getmtime(inputFile) > outputTime:
+            return False
+
+    return True
+
+
+def cached_map(output_file, input_files, compute):
+    # compute(file_name) writes the map to file_name (same extension as output_file). The map is recomputed when one of
+    # input_files is newer than it. Returns output_file
+    if is_up_to_date(output_file, input_files):
+        return output_file
+
+    outputFolder = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(outputFolder, exist_ok=True)
+
+    with open(output_file + ".lock", "w") as lockFile:
+        fcntl.lockf(lockFile, fcntl.LOCK_EX)
+        try:
+            # Another task may have computed it while this one was waiting for the lock
+            if not is_up_to_date(output_file, input_files):
+                tmpFile = os.path.join(outputFolder, "tmp" + str(os.getpid()) + "_" + os.path.basename(output_file))
+                compute(tmpFile)
+                if not os.path.exists(tmpFile):
+                    raise RuntimeError("Could not compute " + output_file)
+
+                os.rename(tmpFile, output_file)
+        finally:
+            fcntl.lockf(lockFile, fcntl.LOCK_UN)
+
+    return output_file
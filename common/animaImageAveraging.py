@@ -0,0 +1,121 @@
+import numpy as np
+
+from animaImageIO import read_image, write_image, read_list_file
+
+# Streaming replacement of animaAverageImages: images are read one at a time (memory-mapped when not compressed) and
+# accumulated slab by slab in float64, so that peak memory does not depend on the number of images.
+
+
+def read_weights(weights_file, num_images):
+    if weights_file == "":
+        return np.ones(num_images)
+
+    weights = np.loadtxt(weights_file, ndmin=1)
+    if len(weights) < num_images:
+        raise ValueError("Weights file " + weights_file + " has fewer weights than the " + str(num_images) + " images")
+
+    return weights[:num_images]
+
+
+def significant_weights(weights, min_weight=0, mass_fraction=1):
+    # Indices (in increasing order) of the images kept in a weighted average: weights normalized to sum 1 have to be at
+    # least min_weight, and only the largest weights totalling mass_fraction of the sum are kept. The largest weight is
+    # always kept
+    normalizedWeights = np.asarray(weights, dtype=float) / np.sum(weights)
+    order = np.argsort(-normalizedWeights, kind='stable')
+
+    numKept = len(order)
+    if mass_fraction < 1:
+        numKept = int(np.searchsorted(np.cumsum(normalizedWeights[order]), mass_fraction * (1 - 1e-12))) + 1
+    numKept = max(1, min(numKept, int(np.sum(normalizedWeights >= min_weight))))
+
+    return np.sort(order[:numKept])
+
+
+def accumulate_images(image_files, weights, mask_files=None, slab_size=16):
+    # Returns the weighted sum of the images, the sum of weights (a scalar, or an image when masks are given) and the
+    # header of the first image
+    if mask_files is not None and len(mask_files) != len(image_files):
+        raise ValueError("Got " + str(len(mask_files)) + " masks for " + str(len(image_files)) + " images")
+
+    weightedSum = None
+    weightSum = 0.0
+    refHeader = None
+    for i in range(len(image_files)):
+        data, header = read_image(image_files[i])
+        if weightedSum is None:
+            weightedSum = np.zeros(data.shape)
+            refHeader = header
+        elif data.shape != weightedSum.shape:
+            raise ValueError(image_files[i] + " does not have the same size as " + image_files[0])
+
+        if mask_files is None:
+            weightSum += weights[i]
+            for start in range(0, data.shape[0], slab_size):
+                weightedSum[start:start + slab_size] += weights[i] * np.asarray(data[start:start + slab_size], dtype=np.float64)
+            continue
+
+        mask, _ = read_image(mask_files[i])
+        if np.isscalar(weightSum):
+            weightSum = np.zeros(mask.shape)
+
+        # Masks are scalar images, broadcast over the components of vector images
+        componentDims = (1,) * (data.ndim - mask.ndim)
+        for start in range(0, data.shape[0], slab_size):
+            maskWeights = weights[i] * (np.asarray(mask[start:start + slab_size]) != 0)
+            weightSum[start:start + slab_size] += maskWeights
+            weightedSum[start:start + slab_size] += np.asarray(data[start:start + slab_size], dtype=np.float64) * \
+                maskWeights.reshape(maskWeights.shape + componentDims)
+
+    return weightedSum, weightSum, refHeader
+
+
+def normalize_sum(weighted_sum, weight_sum):
+    if np.isscalar(weight_sum):
+        return weighted_sum / weight_sum
+
+    weightSum = weight_sum.reshape(weight_sum.shape + (1,) * (weighted_sum.ndim - weight_sum.ndim))
+    average = np.zeros(weighted_sum.shape)
+    np.divide(weighted_sum, weightSum, out=average, where=np.broadcast_to(weightSum > 0, weighted_sum.shape))
+    return average
+
+
+def output_dtype(header):
+    if np.issubdtype(header["dtype"], np.floating):
+        return header["dtype"]
+
+    return np.dtype(np.float64)
+
+
+def average_images(images_list_file, output_file, weights_file="", masks_list_file=""):
+    # Same inputs as animaAverageImages: text files listing the images and masks, one weight per line
+    imageFiles = read_list_file(images_list_file)
+    maskFiles = None
+    if masks_list_file != "":
+        maskFiles = read_list_file(masks_list_file)
+
+    weightedSum, weightSum, header = accumulate_images(imageFiles, read_weights(weights_file, len(imageFiles)), maskFiles)
+    write_image(output_file, normalize_sum(weightedSum, weightSum).astype(output_dtype(header)), header)
+
+
+def save_partial_sum(prefix, weighted_sum, weight_sum):
+    # Partial sums of a tree reduction over groups of images, kept in full precision
+    np.save(prefix + "_sum.npy", weighted_sum)
+    np.save(prefix + "_weights.npy", np.asarray(weight_sum))
+
+
+def combine_partial_sums(prefixes):
+    weightedSum = None
+    weightSum = 0.0
+    for prefix in prefixes:
+        partialSum = np.load(prefix + "_sum.npy", mmap_mode="r")
+        if weightedSum is None:
+            weightedSum = np.array(partialSum)
+        else:
+            weightedSum += partialSum
+        weightSum = weightSum + np.load(prefix + "_weights.npy")
+
+    if np.ndim(weightSum) == 0:
+        weightSum = float(weightSum)
+
+    return weightedSum, weightSum
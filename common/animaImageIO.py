@@ -0,0 +1,179 @@
+import bz2
+import gzip
+import os
+
+import numpy as np
+
+# Minimal NRRD / NIfTI input and output for in-process processing. Images are kept in their file layout: NRRD arrays are
+# in C order (slowest axis first, vector components last) and NIfTI arrays in nibabel order (x first). Spatial axes
+# always come first, which is all that voxel-wise processing needs.
+
+NRRD_TYPES = {
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "longlong": "i8", "long long": "i8", "long long int": "i8", "signed long long": "i8",
+    "signed long long int": "i8", "int64": "i8", "int64_t": "i8",
+    "ulonglong": "u8", "unsigned long long": "u8", "unsigned long long int": "u8", "uint64": "u8", "uint64_t": "u8",
+    "float": "f4", "double": "f8"
+}
+
+NRRD_TYPE_NAMES = {"i1": "int8", "u1": "uint8", "i2": "short", "u2": "unsigned short", "i4": "int",
+                   "u4": "unsigned int", "i8": "long long", "u8": "unsigned long long", "f4": "float", "f8": "double"}
+
+# Fields rewritten when saving an image from a reference header
+NRRD_DATA_FIELDS = ["type", "encoding", "endian", "data file", "datafile", "byte skip", "byteskip", "line skip",
+                    "lineskip", "content"]
+
+
+def is_nrrd(file_name):
+    return file_name.endswith(".nrrd") or file_name.endswith(".nhdr")
+
+
+def read_nrrd_header(file_name):
+    fields = []
+    keyValues = []
+    with open(file_name, "rb") as headerFile:
+        magic = headerFile.readline()
+        if not magic.startswith(b"NRRD"):
+            raise ValueError(file_name + " is not a NRRD file")
+
+        while True:
+            line = headerFile.readline()
+            if line == b"" or line.strip() == b"":
+                break
+
+            line = line.decode("latin-1").rstrip("\r\n")
+            if line.startswith("#"):
+                continue
+
+            if ":=" in line:
+                keyValues += [tuple(line.split(":=", 1))]
+            else:
+                key, value = line.split(":", 1)
+                fields += [(key.strip().lower(), value.strip())]
+
+        dataOffset = headerFile.tell()
+
+    return {"format": "nrrd", "file": file_name, "fields": fields, "keyvalues": keyValues, "offset": dataOffset}
+
+
+def get_nrrd_field(header, key, default=None):
+    for field, value in header["fields"]:
+        if field == key:
+            return value
+
+    return default
+
+
+def read_nrrd(file_name, mmap=True):
+    header = read_nrrd_header(file_name)
+    sizes = [int(size) for size in get_nrrd_field(header, "sizes").split()]
+    dtype = np.dtype(NRRD_TYPES[get_nrrd_field(header, "type")])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(">" if get_nrrd_field(header, "endian", "little") == "big" else "<")
+
+    encoding = get_nrrd_field(header, "encoding", "raw")
+    shape = tuple(reversed(sizes))
+
+    dataFile = get_nrrd_field(header, "data file", get_nrrd_field(header, "datafile"))
+    offset = header["offset"]
+    if dataFile is not None:
+        dataFile = os.path.join(os.path.dirname(file_name), dataFile)
+        offset = 0
+    else:
+        dataFile = file_name
+
+    offset += int(get_nrrd_field(header, "byte skip", get_nrrd_field(header, "byteskip", "0")))
+    if encoding == "raw":
+        if mmap:
+            data = np.memmap(dataFile, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            data = np.fromfile(dataFile, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    elif encoding in ["gzip", "gz", "bzip2", "bz2"]:
+        with open(dataFile, "rb") as compressedFile:
+            compressedFile.seek(offset)
+            if encoding in ["gzip", "gz"]:
+                rawData = gzip.GzipFile(fileobj=compressedFile).read()
+            else:
+                rawData = bz2.decompress(compressedFile.read())
+        data = np.frombuffer(rawData, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    else:
+        raise ValueError("Unsupported NRRD encoding " + encoding + " in " + file_name)
+
+    header["dtype"] = dtype.newbyteorder("=")
+    header["shape"] = shape
+    return data, header
+
+
+def write_nrrd(file_name, data, header, compress=True):
+    data = np.ascontiguousarray(data)
+    dtype = data.dtype.newbyteorder("=")
+    lines = ["NRRD0004", "# Complete NRRD file format specification at:",
+             "# http://teem.sourceforge.net/nrrd/format.html"]
+    for field, value in header["fields"]:
+        if field == "sizes":
+            value = " ".join(str(size) for size in reversed(data.shape))
+        if field not in NRRD_DATA_FIELDS:
+            lines += [field + ": " + value]
+        if field == "dimension":
+            lines += ["type: " + NRRD_TYPE_NAMES[dtype.str[1:]]]
+
+    lines += ["endian: little", "encoding: " + ("gzip" if compress else "raw")]
+    lines += [key + ":=" + value for key, value in header["keyvalues"]]
+
+    rawData = data.astype(dtype.newbyteorder("<"), copy=False).tobytes()
+    with open(file_name, "wb") as outFile:
+        outFile.write(("\n".join(lines) + "\n\n").encode("latin-1"))
+        if compress:
+            outFile.write(gzip.compress(rawData, compresslevel=6))
+        else:
+            outFile.write(rawData)
+
+
+def read_nifti(file_name, mmap=True):
+    try:
+        import nibabel as nib
+    except ImportError:
+        raise ImportError("nibabel is needed to read NIfTI images (" + file_name + ")")
+
+    image = nib.load(file_name, mmap=mmap)
+    data = np.asanyarray(image.dataobj)
+    return data, {"format": "nifti", "file": file_name, "image": image, "dtype": data.dtype, "shape": data.shape}
+
+
+def write_nifti(file_name, data, header):
+    import nibabel as nib
+
+    outHeader = header["image"].header.copy()
+    outHeader.set_data_dtype(data.dtype)
+    outImage = nib.Nifti1Image(np.asarray(data), header["image"].affine, header=outHeader)
+    outImage.header.set_slope_inter(1, 0)
+    nib.save(outImage, file_name)
+
+
+def read_image(file_name, mmap=True):
+    # Returns the voxel array (memory-mapped whenever the file is not compressed) and the header used to write images
+    # on the same geometry
+    if is_nrrd(file_name):
+        return read_nrrd(file_name, mmap)
+
+    return read_nifti(file_name, mmap)
+
+
+def write_image(file_name, data, header):
+    if is_nrrd(file_name) != (header["format"] == "nrrd"):
+        raise ValueError("Output " + file_name + " should have the same format as " + header["file"])
+
+    if is_nrrd(file_name):
+        write_nrrd(file_name, data, header)
+    else:
+        write_nifti(file_name, data, header)
+
+
+def read_list_file(file_name):
+    with open(file_name) as listFile:
+        return [line.strip() for line in listFile if line.strip() != ""]
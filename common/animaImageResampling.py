@@ -0,0 +1,86 @@
+import re
+
+import numpy as np
+
+from animaImageIO import get_nrrd_field, read_image, write_image
+
+# Integer factor downsampling of images by block averaging, used to run the first atlas iterations on coarser grids.
+# Geometry is kept consistent: voxel size is multiplied by the factor and the origin moved to the center of the first
+# block, so that downsampled images stay in the same physical space as the original ones.
+
+
+def block_average(data, factor):
+    # The first three axes are spatial (in both NRRD and NIfTI layouts), trailing ones (components) are kept
+    shape = [int(size / factor) for size in data.shape[:3]]
+    cropped = np.asarray(data[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor], dtype=np.float64)
+    blocks = cropped.reshape([shape[0], factor, shape[1], factor, shape[2], factor] + list(data.shape[3:]))
+    return blocks.mean(axis=(1, 3, 5))
+
+
+def parse_nrrd_vector(vector):
+    return [float(value) for value in vector.strip("()").split(",")]
+
+
+def format_nrrd_vector(vector):
+    return "(" + ",".join(repr(value) for value in vector) + ")"
+
+
+def downsample_nrrd_header(header, factor):
+    directions = re.findall(r"none|\([^)]*\)", get_nrrd_field(header, "space directions", ""))
+    spatialDirections = [parse_nrrd_vector(direction) for direction in directions if direction != "none"]
+
+    fields = []
+    for field, value in header["fields"]:
+        if field == "space directions":
+            value = " ".join(direction if direction == "none" else
+                             format_nrrd_vector([factor * coordinate for coordinate in parse_nrrd_vector(direction)])
+                             for direction in directions)
+        elif field == "space origin":
+            origin = parse_nrrd_vector(value)
+            for direction in spatialDirections:
+                origin = [origin[i] + (factor - 1) / 2.0 * direction[i] for i in range(len(origin))]
+            value = format_nrrd_vector(origin)
+        elif field == "spacings":
+            value = " ".join(spacing if spacing.lower() == "nan" else repr(factor * float(spacing))
+                             for spacing in value.split())
+        fields += [(field, value)]
+
+    outHeader = dict(header)
+    outHeader["fields"] = fields
+    return outHeader
+
+
+def downsample_nifti_header(header, factor):
+    import nibabel as nib
+
+    affine = header["image"].affine.copy()
+    affine[:3, 3] += affine[:3, :3].dot(np.full(3, (factor - 1) / 2.0))
+    affine[:3, :3] *= factor
+
+    outHeader = dict(header)
+    outHeader["image"] = nib.Nifti1Image(np.zeros((1, 1, 1)), affine, header=header["image"].header)
+    return outHeader
+
+
+def downsample_image(input_file, output_file, factor):
+    data, header = read_image(input_file)
+    outData = block_average(data, factor)
+    if np.issubdtype(data.dtype, np.floating):
+        outData = outData.astype(data.dtype)
+    else:
+        outData = outData.astype(np.float32)
+
+    if header["format"] == "nrrd":
+        write_image(output_file, outData, downsample_nrrd_header(header, factor))
+    else:
+        write_image(output_file, outData, downsample_nifti_header(header, factor))
+
+
+def write_identity_transform(output_file):
+    myfile = open(output_file, "w")
+    myfile.write("#Insight Transform File V1.0\n")
+    myfile.write("# Transform 0\n")
+    myfile.write("Transform: AffineTransform_double_3_3\n")
+    myfile.write("Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\n")
+    myfile.write("FixedParameters: 0 0 0\n")
+    myfile.close()
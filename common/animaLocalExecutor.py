@@ -0,0 +1,151 @@
+import os
+import signal
+import statistics
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_local_cores(requested_cores):
+    if requested_cores > 0:
+        return requested_cores
+
+    return os.cpu_count() or 1
+
+
+def run_job(command, log_prefix):
+    # Mimics OAR: standard output and error of each job are kept next to the working folder
+    with open(log_prefix + ".output", "w") as outFile, open(log_prefix + ".error", "w") as errFile:
+        procStat = subprocess.run(command, stdout=outFile, stderr=errFile)
+
+    return procStat.returncode
+
+
+def run_jobs(commands, log_prefixes, num_slots):
+    # Runs a job array on the local machine, at most num_slots jobs at the same time.
+    # Return codes are given back in the order of the commands
+    numWorkers = max(1, min(num_slots, len(commands)))
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        returnCodes = list(executor.map(run_job, commands, log_prefixes))
+
+    return returnCodes
+
+
+def straggler_limit(runtimes, num_done, num_jobs, straggler_factor, min_done_fraction):
+    # Running time above which a job is considered a straggler, 0 while too few jobs are done to estimate it
+    if straggler_factor <= 0 or len(runtimes) == 0 or num_done < min_done_fraction * num_jobs:
+        return 0
+
+    return straggler_factor * statistics.median(runtimes)
+
+
+def log_runtimes(stats_file, names, runtimes, attempts):
+    # Runtime (in seconds) and number of attempts of each successful job, then a summary of the array
+    doneRuntimes = [runtime for runtime in runtimes if runtime is not None]
+    if len(doneRuntimes) > 0:
+        print("Job runtimes: median " + str(round(statistics.median(doneRuntimes), 1)) + " s, max " +
+              str(round(max(doneRuntimes), 1)) + " s, " + str(sum(1 for a in attempts if a > 1)) + " relaunched")
+
+    if stats_file == "":
+        return
+
+    with open(stats_file, "a") as statsFile:
+        for name, runtime, numAttempts in zip(names, runtimes, attempts):
+            if runtime is not None:
+                statsFile.write(name + " " + str(round(runtime, 1)) + " " + str(numAttempts) + "\n")
+
+
+def start_attempt(command, log_prefix):
+    # Each attempt is a process group leader, so that terminating it also stops the binaries it runs
+    outFile = open(log_prefix + ".output", "w")
+    errFile = open(log_prefix + ".error", "w")
+    process = subprocess.Popen(command, stdout=outFile, stderr=errFile, start_new_session=True)
+    return process, [outFile, errFile]
+
+
+def terminate_attempt(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def run_speculative_jobs(commands, log_prefixes, num_slots, straggler_factor, min_done_fraction=0.5, stats_file="",
+                         poll_interval=1):
+    # Same as run_jobs, stragglers being relaunched: once min_done_fraction of the jobs are done and no job is waiting,
+    # a job running for more than straggler_factor times the median runtime gets a second attempt on a free slot.
+    # The first attempt to succeed wins and the other one is terminated, commands have to support concurrent attempts
+    numSlots = max(1, num_slots)
+    pendingJobs = list(range(len(commands)))
+    runningAttempts = []
+    returnCodes = [None] * len(commands)
+    runtimes = [None] * len(commands)
+    attempts = [0] * len(commands)
+
+    while len(pendingJobs) > 0 or len(runningAttempts) > 0:
+        for attempt in list(runningAttempts):
+            index, process, startTime, logFiles = attempt
+            returnCode = process.poll()
+            if returnCode is None:
+                continue
+
+            runningAttempts.remove(attempt)
+            for logFile in logFiles:
+                logFile.close()
+
+            if returnCodes[index] is not None:
+                continue
+
+            otherAttempts = [other for other in runningAttempts if other[0] == index]
+            if returnCode == 0 or len(otherAttempts) == 0:
+                returnCodes[index] = returnCode
+                if returnCode == 0:
+                    runtimes[index] = time.time() - startTime
+                for other in otherAttempts:
+                    terminate_attempt(other[1])
+
+        while len(pendingJobs) > 0 and len(runningAttempts) < numSlots:
+            index = pendingJobs.pop(0)
+            attempts[index] += 1
+            process, logFiles = start_attempt(commands[index], log_prefixes[index])
+            runningAttempts += [(index, process, time.time(), logFiles)]
+
+        numDone = sum(1 for returnCode in returnCodes if returnCode is not None)
+        limit = straggler_limit([runtime for runtime in runtimes if runtime is not None], numDone, len(commands),
+                                straggler_factor, min_done_fraction)
+        if len(pendingJobs) == 0 and limit > 0:
+            for index, process, startTime, logFiles in list(runningAttempts):
+                if len(runningAttempts) >= numSlots:
+                    break
+
+                if attempts[index] == 1 and time.time() - startTime > limit:
+                    print("Relaunching straggler " + os.path.basename(log_prefixes[index]) + " after " +
+                          str(round(time.time() - startTime)) + " s")
+                    attempts[index] += 1
+                    process, logFiles = start_attempt(commands[index], log_prefixes[index] + ".retry")
+                    runningAttempts += [(index, process, time.time(), logFiles)]
+
+        if len(runningAttempts) > 0:
+            time.sleep(poll_interval)
+
+    log_runtimes(stats_file, [os.path.basename(logPrefix) for logPrefix in log_prefixes], runtimes, attempts)
+    return returnCodes
+
+
+def run_parallel(function, items, num_workers):
+    # Calls function on each item with a bounded pool of threads (processing is done by external binaries).
+    # Results are given back in the order of the items
+    numWorkers = max(1, min(num_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        results = list(executor.map(function, items))
+
+    return results
+
+
+def split_cores(num_cores, num_tasks, num_workers=0):
+    # Number of concurrent workers and number of threads given to each of them, so that the total matches num_cores
+    if num_workers <= 0:
+        num_workers = max(1, int(num_cores / 2))
+
+    numWorkers = max(1, min(num_workers, num_tasks))
+    return numWorkers, max(1, int(num_cores / numWorkers))
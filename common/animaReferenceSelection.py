@@ -0,0 +1,56 @@
+import numpy as np
+from scipy import ndimage
+
+from animaImageIO import read_image
+from animaImageResampling import block_average
+
+# Selection of the initial atlas reference among the input images. Images are downsampled, then aligned on their
+# intensity moments (center of mass and spread along each axis, i.e. a translation and axis scalings) by resampling them
+# on a small common grid. The medoid, the image with the smallest sum of (1 - normalized cross correlation) distances
+# to all others, is selected.
+
+
+def moment_aligned_image(image_file, grid_size=32):
+    data, _ = read_image(image_file)
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim > 3:
+        # Vector images are compared on their norm
+        data = np.sqrt(np.sum(data.reshape(data.shape[:3] + (-1,)) ** 2, axis=3))
+
+    factor = max(1, int(max(data.shape) / (2 * grid_size)))
+    if factor > 1:
+        data = block_average(data, factor)
+
+    data = np.maximum(data, 0)
+    total = data.sum()
+    if total == 0:
+        return np.zeros(grid_size ** 3, dtype=np.float32)
+
+    axesCoordinates = []
+    for axis in range(3):
+        profile = data.sum(axis=tuple(i for i in range(3) if i != axis))
+        positions = np.arange(data.shape[axis])
+        center = np.sum(profile * positions) / total
+        spread = max(np.sqrt(np.sum(profile * (positions - center) ** 2) / total), 1.0)
+        axesCoordinates += [center + spread * np.linspace(-2.5, 2.5, grid_size)]
+
+    aligned = ndimage.map_coordinates(data, np.meshgrid(*axesCoordinates, indexing="ij"), order=1, mode="constant")
+    aligned = aligned.ravel() - aligned.mean()
+    norm = np.linalg.norm(aligned)
+    if norm > 0:
+        aligned /= norm
+
+    return aligned.astype(np.float32)
+
+
+def medoid_distances(image_files, grid_size=32):
+    # Sum of distances of each image to all others, computed from the Gram matrix of the aligned images
+    alignedImages = np.stack([moment_aligned_image(imageFile, grid_size) for imageFile in image_files])
+    correlations = alignedImages.dot(alignedImages.T)
+    return np.sum(1.0 - correlations, axis=1)
+
+
+def select_medoid(image_files, grid_size=32):
+    # Returns the (0-based) index of the medoid image and the sums of distances of all images
+    distances = medoid_distances(image_files, grid_size)
+    return int(np.argmin(distances)), distances
@@ -0,0 +1,29 @@
+import os
+
+# Coarse to fine schedule of atlas builds: schedule[i] is the integer downsampling factor of iteration i + 1, the last
+# factor being kept for all later iterations. Images of a factor other than 1 are downsampled once into a lowres_<factor>
+# folder next to the original images (see animaImageResampling.downsample_image).
+
+
+def resolution_factor(schedule, iteration):
+    return schedule[min(iteration, len(schedule)) - 1]
+
+
+def level_folder(prefix_base, factor):
+    # Downsampled images are next to the original ones, working folders being defined from their parent folder
+    return os.path.join(os.path.dirname(prefix_base), "lowres_" + str(factor))
+
+
+def level_reference(prefix_base, initial_ref, files_extension, factor):
+    if factor == 1:
+        return initial_ref
+
+    return os.path.join(level_folder(prefix_base, factor), "reference" + files_extension)
+
+
+def next_reference(schedule, average_prefix, iteration, last_iteration):
+    # Reference of the next iteration: the average, resampled by the merge step when the resolution changes
+    if iteration < last_iteration and resolution_factor(schedule, iteration + 1) != resolution_factor(schedule, iteration):
+        return average_prefix + str(iteration) + "_r" + str(resolution_factor(schedule, iteration + 1)) + ".nrrd"
+
+    return average_prefix + str(iteration) + ".nrrd"
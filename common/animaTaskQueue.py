@@ -0,0 +1,247 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from animaCompletionWait import open_inotify, wait_for_events
+from animaLocalExecutor import log_runtimes, straggler_limit
+
+# File based task queue shared by an orchestrator and long-lived pilot workers (e.g. OAR jobs on a shared file system).
+# A task is a JSON file moving between three folders of the queue:
+#   pending/  -> claimed/  : a worker claims it by an atomic rename (only one rename of a given file succeeds)
+#   claimed/  -> finished/ : the worker stores the return code once the command is done
+# While running a task, a worker touches its claimed file (heartbeat). Claimed tasks whose heartbeat is older than a
+# timeout are moved back to pending/ by the orchestrator, so that tasks of dead workers are run again.
+# Creating a "stop" file in the queue folder makes workers exit once their current task is done.
+# Removing a claimed file cancels the task: its worker stops the command at the next heartbeat.
+
+QUEUE_FOLDERS = ["pending", "claimed", "finished"]
+
+
+def init_queue(queue_dir):
+    # Tasks left by an earlier run are dropped, workers still alive keep pulling from the emptied queue
+    for folder in QUEUE_FOLDERS:
+        if os.path.exists(os.path.join(queue_dir, folder)):
+            shutil.rmtree(os.path.join(queue_dir, folder))
+        os.makedirs(os.path.join(queue_dir, folder))
+
+    if os.path.exists(os.path.join(queue_dir, "stop")):
+        os.remove(os.path.join(queue_dir, "stop"))
+
+
+def stop_workers(queue_dir):
+    open(os.path.join(queue_dir, "stop"), "a").close()
+
+
+def write_task(task_file, task):
+    # Written aside then renamed, so that readers never see a partial file
+    tmpFile = task_file + "." + socket.gethostname() + "." + str(os.getpid()) + ".tmp"
+    with open(tmpFile, "w") as taskFile:
+        json.dump(task, taskFile)
+    os.rename(tmpFile, task_file)
+
+
+def read_task(task_file):
+    with open(task_file) as taskFile:
+        return json.load(taskFile)
+
+
+def submit_task(queue_dir, name, command, log_prefix):
+    for folder in ["claimed", "finished"]:
+        if os.path.exists(os.path.join(queue_dir, folder, name + ".json")):
+            os.remove(os.path.join(queue_dir, folder, name + ".json"))
+
+    write_task(os.path.join(queue_dir, "pending", name + ".json"),
+               {"name": name, "command": command, "log": log_prefix, "attempts": 0})
+
+
+def claim_task(queue_dir):
+    # Returns the path of the claimed task file, or an empty string if no task is pending
+    for taskName in sorted(os.listdir(os.path.join(queue_dir, "pending"))):
+        if not taskName.endswith(".json"):
+            continue
+
+        claimedFile = os.path.join(queue_dir, "claimed", taskName)
+        try:
+            os.rename(os.path.join(queue_dir, "pending", taskName), claimedFile)
+        except OSError:
+            # Claimed by another worker in the meantime
+            continue
+
+        os.utime(claimedFile)
+        return claimedFile
+
+    return ""
+
+
+def run_claimed_task(queue_dir, claimed_file, heartbeat_interval=30):
+    task = read_task(claimed_file)
+    task["attempts"] += 1
+    task["host"] = socket.gethostname()
+
+    with open(task["log"] + ".output", "w") as outFile, open(task["log"] + ".error", "w") as errFile:
+        process = subprocess.Popen(task["command"], stdout=outFile, stderr=errFile, start_new_session=True)
+        try:
+            while True:
+                try:
+                    task["returncode"] = process.wait(timeout=heartbeat_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    try:
+                        os.utime(claimed_file)
+                    except OSError:
+                        # Requeued (heartbeat missed) or cancelled by the orchestrator
+                        return
+        finally:
+            # The task runs in its own session: it is stopped with the worker (SIGTERM, error), otherwise it would go on
+            # next to its requeued copy, both writing the same outputs
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+    try:
+        write_task(os.path.join(queue_dir, "finished", task["name"] + ".json"), task)
+        os.remove(claimed_file)
+    except OSError:
+        pass
+
+
+def requeue_stale_tasks(queue_dir, heartbeat_timeout):
+    # Returns the number of requeued tasks
+    numRequeued = 0
+    for taskName in os.listdir(os.path.join(queue_dir, "claimed")):
+        claimedFile = os.path.join(queue_dir, "claimed", taskName)
+        try:
+            if time.time() - os.path.getmtime(claimedFile) > heartbeat_timeout:
+                os.rename(claimedFile, os.path.join(queue_dir, "pending", taskName))
+                print("Requeued task " + taskName + " (no heartbeat for " + str(heartbeat_timeout) + " s)")
+                numRequeued += 1
+        except OSError:
+            # Finished or requeued in the meantime
+            continue
+
+    return numRequeued
+
+
+def cancel_task(queue_dir, name):
+    for folder in ["pending", "claimed"]:
+        if os.path.exists(os.path.join(queue_dir, folder, name + ".json")):
+            try:
+                os.remove(os.path.join(queue_dir, folder, name + ".json"))
+            except OSError:
+                pass
+
+
+def run_queued_jobs(queue_dir, commands, log_prefixes, names, heartbeat_timeout=300, max_delay=10, straggler_factor=0,
+                    min_done_fraction=0.5, stats_file="", worker_timeout=1800):
+    # Same role as animaLocalExecutor.run_jobs (or run_speculative_jobs when straggler_factor > 0): runs the commands
+    # through the queue and gives back their return codes in the order of the commands. A relaunched straggler is a
+    # second task named after the first one, the first of them to succeed wins and the other one is cancelled.
+    # Once tasks were requeued for a missed heartbeat, no task being claimed again for worker_timeout seconds means that
+    # no worker is left: unfinished tasks are then cancelled and given a -1 return code (0 to wait for workers forever)
+    for command, logPrefix, name in zip(commands, log_prefixes, names):
+        submit_task(queue_dir, name, command, logPrefix)
+
+    finishedFolder = os.path.join(queue_dir, "finished")
+    fd = open_inotify(finishedFolder)
+    returnCodes = {}
+    startTimes = {}
+    runtimes = {}
+    attempts = dict((name, 1) for name in names)
+    staleTime = None
+    delay = 1
+    try:
+        while len(returnCodes) < len(names):
+            for name in names:
+                if name in returnCodes:
+                    continue
+
+                taskNames = [name]
+                if attempts[name] > 1:
+                    taskNames += [name + ".retry"]
+                for taskName in taskNames:
+                    if taskName not in startTimes and os.path.exists(os.path.join(queue_dir, "claimed", taskName + ".json")):
+                        startTimes[taskName] = time.time()
+
+                finishedTasks = [taskName for taskName in taskNames if os.path.exists(os.path.join(finishedFolder, taskName + ".json"))]
+                for taskName in finishedTasks:
+                    returnCode = read_task(os.path.join(finishedFolder, taskName + ".json"))["returncode"]
+                    if returnCode == 0 or len(finishedTasks) == len(taskNames):
+                        returnCodes[name] = returnCode
+                        if returnCode == 0 and taskName in startTimes:
+                            runtimes[name] = time.time() - startTimes[taskName]
+                        for otherName in taskNames:
+                            if otherName != taskName:
+                                cancel_task(queue_dir, otherName)
+                        break
+
+            if len(returnCodes) == len(names):
+                break
+
+            if requeue_stale_tasks(queue_dir, heartbeat_timeout) > 0 and staleTime is None:
+                staleTime = time.time()
+            elif len(os.listdir(os.path.join(queue_dir, "claimed"))) > 0:
+                staleTime = None
+
+            if worker_timeout > 0 and staleTime is not None and time.time() - staleTime > worker_timeout:
+                print("No worker claimed any task for " + str(worker_timeout) + " s after tasks were requeued, giving up " +
+                      str(len(names) - len(returnCodes)) + " unfinished tasks")
+                for name in names:
+                    if name not in returnCodes:
+                        returnCodes[name] = -1
+                        cancel_task(queue_dir, name)
+                        cancel_task(queue_dir, name + ".retry")
+                break
+
+            limit = straggler_limit(list(runtimes.values()), len(returnCodes), len(names), straggler_factor, min_done_fraction)
+            if limit > 0 and len(os.listdir(os.path.join(queue_dir, "pending"))) == 0:
+                for command, logPrefix, name in zip(commands, log_prefixes, names):
+                    if name not in returnCodes and attempts[name] == 1 and name in startTimes and time.time() - startTimes[name] > limit:
+                        print("Relaunching straggler " + name + " after " + str(round(time.time() - startTimes[name])) + " s")
+                        attempts[name] += 1
+                        submit_task(queue_dir, name + ".retry", command, logPrefix + ".retry")
+
+            if wait_for_events(fd, delay):
+                delay = 1
+            else:
+                delay = min(max_delay, delay * 1.5)
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
+    log_runtimes(stats_file, names, [runtimes.get(name) for name in names], [attempts[name] for name in names])
+    return [returnCodes[name] for name in names]
+
+
+def run_worker(queue_dir, heartbeat_interval=30, idle_timeout=600, max_delay=10):
+    # Pulls and runs tasks until the queue is stopped or no task came for idle_timeout seconds
+    # Exiting on SIGTERM (e.g. oardel or the walltime) stops the running task on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    pendingFolder = os.path.join(queue_dir, "pending")
+    fd = open_inotify(pendingFolder)
+    lastTaskTime = time.time()
+    delay = 1
+    try:
+        while not os.path.exists(os.path.join(queue_dir, "stop")):
+            claimedFile = claim_task(queue_dir)
+            if claimedFile != "":
+                run_claimed_task(queue_dir, claimedFile, heartbeat_interval)
+                lastTaskTime = time.time()
+                delay = 1
+                continue
+
+            if idle_timeout > 0 and time.time() - lastTaskTime > idle_timeout:
+                break
+
+            if wait_for_events(fd, delay):
+                delay = 1
+            else:
+                delay = min(max_delay, delay * 1.5)
+    finally:
+        if fd >= 0:
+            os.close(fd)
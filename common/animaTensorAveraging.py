@@ -0,0 +1,55 @@
+import numpy as np
+
+from animaImageAveraging import output_dtype
+from animaImageIO import read_image, write_image
+
+# In-process replacement of the ADC masking of the DTI atlas merge (animaDTIScalarMaps, animaThrImage, animaAverageImages
+# with masks, then animaThrImage and animaMaskImage on the mean mask). Tensors are read one at a time and accumulated slab
+# by slab: the mask of a tensor (positive ADC) and the mean mask are computed on the fly, without intermediate images.
+
+# Anima stores tensors as 6 components in lower triangular order: xx, xy, yy, xz, yz, zz
+TENSOR_DIAGONAL = [0, 2, 5]
+
+
+def tensor_mask(tensors):
+    # Positive ADC (a third of the trace), as animaThrImage -t 0 on the output of animaDTIScalarMaps -a
+    return np.asarray(tensors[..., TENSOR_DIAGONAL], dtype=np.float64).sum(axis=-1) > 0
+
+
+def accumulate_tensors(image_files, weights, slab_size=16):
+    # Returns the weighted sum of the tensors within their masks, the weighted sum of the masks and the header of the
+    # first image
+    weightedSum = None
+    maskSum = None
+    refHeader = None
+    for i in range(len(image_files)):
+        data, header = read_image(image_files[i])
+        if data.shape[-1] != 6:
+            raise ValueError(image_files[i] + " is not a tensor image (6 components last)")
+
+        if weightedSum is None:
+            weightedSum = np.zeros(data.shape)
+            maskSum = np.zeros(data.shape[:-1])
+            refHeader = header
+        elif data.shape != weightedSum.shape:
+            raise ValueError(image_files[i] + " does not have the same size as " + image_files[0])
+
+        for start in range(0, data.shape[0], slab_size):
+            slab = np.asarray(data[start:start + slab_size], dtype=np.float64)
+            maskWeights = weights[i] * tensor_mask(slab)
+            maskSum[start:start + slab_size] += maskWeights
+            weightedSum[start:start + slab_size] += slab * maskWeights[..., np.newaxis]
+
+    return weightedSum, maskSum, refHeader
+
+
+def average_tensors(image_files, output_file, weights, mean_mask_threshold=0.25):
+    # Masked average of the tensors, kept where the weighted mean of the masks is above mean_mask_threshold
+    weightedSum, maskSum, header = accumulate_tensors(image_files, weights)
+
+    average = np.zeros(weightedSum.shape)
+    np.divide(weightedSum, maskSum[..., np.newaxis], out=average,
+              where=np.broadcast_to((maskSum > 0)[..., np.newaxis], weightedSum.shape))
+    average[maskSum / np.sum(weights) <= mean_mask_threshold] = 0
+
+    write_image(output_file, average.astype(output_dtype(header)), header)
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+# XML transformation list read by anima transform serie tools (animaApplyTransformSerie and the like). Lists are written
+# by animaTransformSerieXmlGenerator whenever it is installed: the in-process writer below has not yet been checked to
+# give byte identical files, and is only used as a fallback when the generator cannot be found.
+
+
+def transform_serie_xml_generator():
+    # Path of animaTransformSerieXmlGenerator from the Anima scripts configuration, empty if it is not available
+    configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
+    if not os.path.exists(configFilePath):
+        return ""
+
+    configParser = ConfParser.RawConfigParser()
+    configParser.read(configFilePath)
+    try:
+        generator = os.path.join(configParser.get("anima-scripts", 'anima'), "animaTransformSerieXmlGenerator")
+    except (ConfParser.NoSectionError, ConfParser.NoOptionError):
+        return ""
+
+    if not os.access(generator, os.X_OK):
+        return ""
+
+    return generator
+
+
+def write_transform_serie_xml(transforms, output_file, inversions=None, dense=False):
+    # transforms: list of transform files, as given with -i to animaTransformSerieXmlGenerator
+    # inversions: optional list of 0/1 inversion flags (-I), missing flags being 0
+    # dense: non linear transforms are dense fields instead of SVFs (-D)
+    if inversions is None:
+        inversions = []
+
+    generator = transform_serie_xml_generator()
+    if generator != "":
+        command = [generator, "-o", output_file]
+        for transform in transforms:
+            command += ["-i", transform]
+        for invertValue in inversions:
+            command += ["-I", str(int(invertValue))]
+        if dense:
+            command += ["-D"]
+
+        subprocess.call(command)
+        return
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<TransformationList>"]
+    for i in range(len(transforms)):
+        lines += ["<Transformation>"]
+
+        if os.path.splitext(transforms[i])[1] == ".txt":
+            lines += ["<Type>linear</Type>"]
+        elif dense:
+            lines += ["<Type>dense</Type>"]
+        else:
+            lines += ["<Type>svf</Type>"]
+
+        lines += ["<Path>" + os.path.realpath(transforms[i]) + "</Path>"]
+
+        invertValue = 0
+        if i < len(inversions):
+            invertValue = int(inversions[i])
+        lines += ["<Inversion>" + str(invertValue) + "</Inversion>", "</Transformation>"]
+
+    lines += ["</TransformationList>"]
+
+    with open(output_file, "w") as xmlFile:
+        xmlFile.write("\n".join(lines) + "\n")
@@ -29,6 +29,9 @@ animaDir = configParser.get("anima-scripts", 'anima')
 animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="Prepares DWI for model estimation: gradients reworking on Siemens based on dicoms, denoising, brain masking, distortion correction.")
@@ -63,7 +66,6 @@ animaConvertImage = os.path.join(animaDir,"animaConvertImage")
 animaCropImage = os.path.join(animaDir,"animaCropImage")
 animaMaskImage = os.path.join(animaDir,"animaMaskImage")
 animaMorphologicalOperations = os.path.join(animaDir,"animaMorphologicalOperations")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
 animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
 animaDenseSVFBMRegistration = os.path.join(animaDir,"animaDenseSVFBMRegistration")
@@ -189,8 +191,7 @@ if args.no_disto_correction is False:
 
         idTrsfName = os.path.join(animaDataDir, "id.txt")
         idTrsfXmlName = os.path.join(tmpFolder, "id.xml")
-        idGenCommand = [animaTransformSerieXmlGenerator, "-i", idTrsfName, "-o", idTrsfXmlName]
-        call(idGenCommand)
+        write_transform_serie_xml([idTrsfName], idTrsfXmlName)
 
         resampleB0PACommand = [animaApplyTransformSerie, "-i", args.reverse, "-t", idTrsfXmlName, "-o",
                                tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-g", tmpDWIImagePrefix + "_B0.nrrd"]
@@ -234,9 +235,7 @@ if args.no_disto_correction is False:
             correctionCommand += ["-I", "0"]
         call(correctionCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
-                   tmpT1Prefix + "_rig_tr.xml"]
-        call(command)
+        write_transform_serie_xml([tmpT1Prefix + "_rig_tr.txt"], tmpT1Prefix + "_rig_tr.xml")
 
         command = [animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
                    tmpT1Prefix + "_rig_tr.xml", "-o", tmpDWIImagePrefix + "_roughMask.nrrd", "-g",
@@ -311,9 +310,7 @@ if args.no_brain_masking is False:
 
         call(t1RegistrationCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
-                   tmpT1Prefix + "_rig_tr.xml"]
-        call(command)
+        write_transform_serie_xml([tmpT1Prefix + "_rig_tr.txt"], tmpT1Prefix + "_rig_tr.xml")
 
         command = [animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
                    tmpT1Prefix + "_rig_tr.xml", "-o", dwiImagePrefix + "_brainMask.nrrd", "-g",
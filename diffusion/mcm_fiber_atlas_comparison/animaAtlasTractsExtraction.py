@@ -20,6 +20,10 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -45,7 +49,6 @@ args = parser.parse_args()
 
 animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
 animaThrImage = os.path.join(animaDir, "animaThrImage")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaMCMApplyTransformSerie = os.path.join(animaDir, "animaMCMApplyTransformSerie")
 animaMCMAverageImages = os.path.join(animaDir, "animaMCMAverageImages")
@@ -85,10 +88,10 @@ maskListFile = open(os.path.join('Transformed_MCM', 'listMasks.txt'), "w")
 
 for dataNum in range(1, args.num_subjects + 1):
     # Apply transformations to additional MCM, assumes all transforms are in residualDir
-    trsfGeneratorCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_linear_tr.txt"),
-                            "-i", os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_nonlinear_tr.nrrd"),
-                            "-i", os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"), "-o", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml")]
-    call(trsfGeneratorCommand)
+    write_transform_serie_xml([os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_linear_tr.txt"),
+                               os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_nonlinear_tr.nrrd"),
+                               os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")],
+                              os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"))
 
     mcmApplyCommand = [animaMCMApplyTransformSerie,
                        "-i", os.path.join(mcmPrefixBase, mcmPrefix + "_" + str(dataNum) + ".mcm"),
@@ -25,6 +25,9 @@ configParser.read(configFilePath)
 animaDir = configParser.get("anima-scripts", 'anima')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 # Argument parsing
 parser = argparse.ArgumentParser(description="Given a fiber atlas constructed from controls data, and a patient image, performs patient to atlas comparison")
 parser.add_argument('-n', '--num-subjects', type=int, required=True,
@@ -55,7 +58,6 @@ args = parser.parse_args()
 
 animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
 animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaCreateImage = os.path.join(animaDir, "animaCreateImage")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaMaskImage = os.path.join(animaDir, "animaMaskImage")
@@ -162,8 +164,8 @@ regCommand = [animaPyramidalBMRegistration, "-r", os.path.join(tmpFolder, "avera
               "--ot", "2", "-p", "3", "-l", "0", "-I", "2", "--sym-reg", "2", "-s", "0"]
 call(regCommand)
 
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-o", os.path.join(tmpFolder, "Patient_aff_tr.xml")]
-call(command)
+write_transform_serie_xml([os.path.join(tmpFolder, "Patient_aff_tr.txt")],
+                          os.path.join(tmpFolder, "Patient_aff_tr.xml"))
 
 command = [animaCreateImage, "-b", "1", "-v", "1", "-g", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
            "-o", os.path.join(tmpFolder,"tmpFullMask.nrrd")]
@@ -189,9 +191,9 @@ command = [animaDenseTensorSVFBMRegistration, "-r", os.path.join(tmpFolder, "ref
 call(command)
 
 # Non linear registration done. Now applying to MCM image
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-i", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"),
-           "-o", os.path.join(tmpFolder, "Patient_nl_tr.xml")]
-call(command)
+write_transform_serie_xml([os.path.join(tmpFolder, "Patient_aff_tr.txt"),
+                           os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd")],
+                          os.path.join(tmpFolder, "Patient_nl_tr.xml"))
 
 mcmApplyCommand = [animaMCMApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg.mcm"),
                    "-o", os.path.join('Transformed_Patients_MCM', dwiPrefix + "_MCM_avg_onAtlas.mcm"),
@@ -224,9 +226,10 @@ else:
 
 call(t1RegistrationCommand)
 
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "T1_reg_rig_tr.txt"), "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"),
-           "-i", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"), "-o", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml")]
-call(command)
+write_transform_serie_xml([os.path.join(tmpFolder, "T1_reg_rig_tr.txt"),
+                           os.path.join(tmpFolder, "Patient_aff_tr.txt"),
+                           os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd")],
+                          os.path.join(tmpFolder, "Patient_T1_nl_tr.xml"))
 
 # Process tracks: augmenting with patient and perform comparison
 for track in tracksLists:
@@ -28,6 +28,9 @@ animaDir = configParser.get("anima-scripts", 'anima')
 animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="Given a set of DW images, arranges them for atlas construction: preprocessing, DTI and MCM "
@@ -67,7 +70,6 @@ args = parser.parse_args()
 
 animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
 animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaImageArithmetic = os.path.join(animaDir, "animaImageArithmetic")
 animaThrImage = os.path.join(animaDir, "animaThrImage")
@@ -157,8 +159,8 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
                     "-O", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt"), "-s", "0"]
     call(regFACommand)
 
-    trsfSerieGenCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt"), "-o", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml")]
-    call(trsfSerieGenCommand)
+    write_transform_serie_xml([os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt")],
+                              os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml"))
 
     applyTrsfCommand = [animaApplyTransformSerie, "-i", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".nrrd"), "-t", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml"),
                         "-g", tractsegFATemplate, "-o", os.path.join(tmpFolder, "DWI_MNI.nii.gz"), "--grad", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".bvec"),
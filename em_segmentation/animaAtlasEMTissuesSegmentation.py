@@ -25,9 +25,13 @@ configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
 animaExtraDataDir = configParser.get("anima-scripts", 'extra-data-root')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
 animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaTissuesEMClassification = os.path.join(animaDir, "animaTissuesEMClassification")
 animaConvertImage = os.path.join(animaDir, "animaConvertImage")
@@ -137,9 +141,9 @@ command = [animaDenseSVFBMRegistration, "-r", brainImagePrefix + '_biasCorrected
            "-o", brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--tub", "2"] + pyramidOptions
 call(command)
 
-command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt", "-i",
-           brainImagePrefix + "_nl_tr.nrrd", "-o", brainImagePrefix + "_nl_tr.xml"]
-call(command)
+write_transform_serie_xml([brainImagePrefix + "_aff_tr.txt",
+                           brainImagePrefix + "_nl_tr.nrrd"],
+                          brainImagePrefix + "_nl_tr.xml")
 
 command = [animaApplyTransformSerie, "-i", tissuesImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImages[0],
            "-o", brainImagePrefix + "_PriorTissues.nrrd"]
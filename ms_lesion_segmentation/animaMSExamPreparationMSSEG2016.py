@@ -22,6 +22,10 @@ configParser = ConfParser.RawConfigParser()
 configParser.read(configFilePath)
 
 animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
 
 parser = argparse.ArgumentParser(
     prog='animaMSExamPreparationMSSEG2016',
@@ -48,7 +52,6 @@ if not os.path.isdir(tmpFolder):
 
 # Anima commands
 animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
 animaMaskImage = os.path.join(animaDir, "animaMaskImage")
 animaNLMeans = os.path.join(animaDir, "animaNLMeans")
@@ -82,9 +85,7 @@ rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m",
                             os.path.join(tmpFolder, "t1Reg.nrrd"), "-O", os.path.join(tmpFolder, "t1Reg_tr.txt")] + pyramidOptions
 call(rigidRegistrationCommand)
 
-trsfGenCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "t1Reg_tr.txt"),
-                  "-o", os.path.join(tmpFolder, "t1Reg_tr.xml")]
-call(trsfGenCommand)
+write_transform_serie_xml([os.path.join(tmpFolder, "t1Reg_tr.txt")], os.path.join(tmpFolder, "t1Reg_tr.xml"))
 
 brainMask = refImagePrefix + "_brainMask.nii.gz"
 maskTrsfCommand = [animaApplyTransformSerie, "-i", args.mask, "-t", os.path.join(tmpFolder, "t1Reg_tr.xml"),
@@ -110,8 +111,7 @@ for i in range(0, len(listImages)):
                                     registeredDataFile, "-O", registeredDataTrsf] + pyramidOptions
         call(rigidRegistrationCommand)
 
-        trsfGenCommand = [animaTransformSerieXmlGenerator, "-i", registeredDataTrsf, "-o", registeredDataTrsfXml]
-        call(trsfGenCommand)
+        write_transform_serie_xml([registeredDataTrsf], registeredDataTrsfXml)
 
         imTrsfCommand = [animaApplyTransformSerie, "-i", nlmSecondImage, "-t", registeredDataTrsfXml,
                            "-g", refImage, "-o", registeredDataFile, "-n", "sinc"]
@@ -25,6 +25,9 @@ animaDir = configParser.get("anima-scripts", 'anima')
 animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
 animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
 
+sys.path.append(os.path.join(animaScriptsDir, "common"))
+from animaTransformSerieXml import write_transform_serie_xml
+
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="From a 4D input image, computes its brain mask and evaluates the desired relaxometry maps (mono T2, "
@@ -52,7 +55,6 @@ if not os.path.isdir(tmpFolder):
     os.mkdir(tmpFolder)
 
 animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
 animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
 
 inputImage = args.input
@@ -99,9 +101,7 @@ if args.no_brain_masking is False:
 
         call(imageRegistrationCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpImagePrefix + "_rig_tr.txt", "-o",
-                   tmpImagePrefix + "_rig_tr.xml"]
-        call(command)
+        write_transform_serie_xml([tmpImagePrefix + "_rig_tr.txt"], tmpImagePrefix + "_rig_tr.xml")
 
         resampleCommand = [animaApplyTransformSerie, "-i", outputMask, "-t",
                            tmpImagePrefix + "_rig_tr.xml", "-o", os.path.join(tmpFolder, "generatorMask.nrrd"),
@@ -115,9 +115,7 @@ if args.no_brain_masking is False:
 t1Image = ""
 # Resample T1 image if it is there
 if args.T1 != "":
-    xmlCommand = [animaDir + "animaTransformSerieXmlGenerator", "-i", os.path.join(animaDataDir, "id.txt"),
-                  "-o", os.path.join(tmpFolder, "id.xml")]
-    call(xmlCommand)
+    write_transform_serie_xml([os.path.join(animaDataDir, "id.txt")], os.path.join(tmpFolder, "id.xml"))
 
     resampleCommand = [animaDir + "animaApplyTransformSerie", "-i", args.T1, "-o",
                        os.path.join(tmpFolder, "t1Resampled.nrrd"), "-t", os.path.join(tmpFolder, "id.xml"),